@@ -0,0 +1,104 @@
+#!/usr/bin/env python -u
+"""
+Benchmark of .torrent decoding on a directory of real .torrent files,
+what Torrent.digest_torfile needs: infohash, name, size and file list.
+
+bencode  - bencode package, decode all, hash of re-encoded info
+lazy     - my_torrent_stuff.LazyDict, hash of the info bytes as in the
+           file, pieces never decoded
+
+Files whose hashes differ between the two are non-canonical, re-encoding
+gives a hash nobody else has for them.
+"""
+
+import os
+import time
+import hashlib
+import bencode
+import my_torrent_stuff
+
+VERSION = "0.0.1"
+
+
+def with_bencode(data: bytes):
+    torinfo = bencode.bdecode(data)
+    info = torinfo['info']
+    files = info.get('files') or [{'length': info['length'], 'path': [info['name']]}]
+    size = sum(file['length'] for file in files)
+    return hashlib.sha1(bencode.bencode(info)).hexdigest(), info['name'], size, len(files)
+
+
+def with_lazy(data: bytes):
+    torinfo = my_torrent_stuff.LazyDict(data)
+    info = torinfo.lazy('info')
+    files = info.get('files') or [{'length': info['length'], 'path': [info['name']]}]
+    size = sum(file['length'] for file in files)
+    return hashlib.sha1(torinfo.span('info')).hexdigest(), info['name'], size, len(files)
+
+
+def load_library(directory: str) -> list:
+    library = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if not name.endswith('.torrent'):
+                continue
+            with open(os.path.join(root, name), 'rb') as f_h:
+                library.append((name, f_h.read()))
+            if args.limit and len(library) >= args.limit:
+                return library
+    return library
+
+
+def run(library: list, name: str, func) -> dict:
+    results = {}
+    best = None
+    for _ in range(args.repeat):
+        failed = 0
+        start = time.perf_counter()
+        for filename, data in library:
+            try:
+                results[filename] = func(data)
+            except Exception:   # pylint: disable=broad-except
+                failed += 1
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print('{:8} {:8.2f}ms  {:8.1f}us per file, {} failed'.format(
+        name, best * 1000, best / len(library) * 1e6, failed))
+    return results
+
+
+def main():
+    library = load_library(args.dir)
+    if not library:
+        print('no .torrent files in', args.dir)
+        return
+    print('{} files, {:.1f}MiB'.format(
+        len(library), sum(len(data) for _, data in library) / 2**20))
+    reference = run(library, 'bencode', with_bencode)
+    lazy = run(library, 'lazy', with_lazy)
+
+    mismatched = 0
+    for filename, result in lazy.items():
+        if filename in reference and reference[filename][0] != result[0]:
+            mismatched += 1
+            if args.verbose:
+                print('hash differs', filename, reference[filename][0], result[0])
+    print('hashes differ (non-canonical files)', mismatched)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Benchmark .torrent decoding against bencode package')
+    parser.add_argument('-d', '-dir', dest='dir', default='.', type=str,
+                        help='directory searched for .torrent files')
+    parser.add_argument('-limit', dest='limit', default=0, type=int,
+                        help='use at most this many files, 0 for all')
+    parser.add_argument('-repeat', dest='repeat', default=3, type=int,
+                        help='runs per decoder, best is reported')
+    parser.add_argument('-v', dest='verbose', default=False, action='store_true',
+                        help='list files whose hashes differ')
+    parser.add_argument('--version', action='version', version=VERSION)
+    args = parser.parse_args()
+
+    main()
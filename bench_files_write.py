@@ -0,0 +1,98 @@
+#!/usr/bin/env python -u
+"""
+Benchmark of Torrent.update_files_db on a synthetic many-file torrent,
+sqlite3 db in memory unless -dbfile is given.
+
+per-row  - one execute per file, how update_db used to write
+full     - empty files list in db, bulk insert of everything
+diff     - half of the list already in db, only the rest is written
+
+In-memory sqlite has no round-trips, the gap to per-row grows with
+the latency of the db connection.
+"""
+
+import time
+import sqlite3
+import my_torrent_stuff
+
+VERSION = "0.0.1"
+
+
+def make_torrent(files: int) -> my_torrent_stuff.Torrent:
+    a_torrent = my_torrent_stuff.Torrent()
+    file_list = []
+    for i in range(files):
+        file_list.append((1000 + i, ['dir{}'.format(i % 100), 'file{}.bin'.format(i)]))
+    a_torrent.record = my_torrent_stuff.TorrentRecord.from_files('synthetic', file_list, 'ab' * 20)
+    return a_torrent
+
+
+def reset_db(conn, a_torrent, prefill: int):
+    cursor = conn.cursor()
+    cursor.execute('delete from torrents')
+    cursor.execute('delete from files')
+    cursor.execute('insert into torrents (id, name, infohash, numfiles, size, added, truename) '
+                   'values (1, ?, ?, 0, ?, 0, ?)',
+                   (a_torrent.fl_name, a_torrent.fl_hexhash, a_torrent.fl_size, ''))
+    rows = []
+    for size, name in a_torrent.fl_file_rows()[:prefill]:
+        rows.append((size, name, 1))
+    cursor.executemany('insert into files (size, name, parenttorrentid) values (?,?,?)', rows)
+    conn.commit()
+
+
+def per_row(conn, a_torrent):
+    cursor = conn.cursor()
+    cursor.execute('delete from files where parenttorrentid = ?', (1,))
+    for size, name in a_torrent.fl_file_rows():
+        cursor.execute('insert into files (size, name, parenttorrentid) values (?,?,?)',
+                       (size, name, 1))
+
+
+def bulk(conn, a_torrent):
+    a_torrent.update_files_db(conn.cursor(), dbtype='sqlite3')
+
+
+def run(conn, a_torrent, name, func, prefill):
+    best = None
+    for _ in range(args.repeat):
+        reset_db(conn, a_torrent, prefill)
+        a_torrent.get_db_info(conn.cursor(), dbtype='sqlite3')
+        start = time.perf_counter()
+        func(conn, a_torrent)
+        conn.commit()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    count = conn.execute('select count(1) from files').fetchone()[0]
+    assert count == a_torrent.record.num_files
+    print('{:8} {:8.2f}ms  ({} rows in db)'.format(name, best * 1000, count))
+
+
+def main():
+    conn = sqlite3.connect(args.dbfile)
+    conn.executescript('create table if not exists torrents (id integer primary key, name, '
+                       'infohash, numfiles, size, added, truename);'
+                       'create table if not exists files (size, name, parenttorrentid);'
+                       'create index if not exists files_parent on files (parenttorrentid);')
+    a_torrent = make_torrent(args.files)
+    print('files in torrent', args.files)
+    run(conn, a_torrent, 'per-row', per_row, 0)
+    run(conn, a_torrent, 'full', bulk, 0)
+    run(conn, a_torrent, 'diff', bulk, args.files // 2)
+    conn.close()
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Benchmark files table writes of Torrent.update_db')
+    parser.add_argument('-files', dest='files', default=10000, type=int,
+                        help='files in the synthetic torrent')
+    parser.add_argument('-repeat', dest='repeat', default=5, type=int,
+                        help='runs per case, best is reported')
+    parser.add_argument('-dbfile', dest='dbfile', default=':memory:', type=str,
+                        help='sqlite db file')
+    parser.add_argument('--version', action='version', version=VERSION)
+    args = parser.parse_args()
+
+    main()
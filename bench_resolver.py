@@ -0,0 +1,159 @@
+#!/usr/bin/env python -u
+"""
+Benchmark of resolver scheduling, spawning, reaping and persisting
+without a swarm or mysql: libtorrent is replaced by fake_libtorrent,
+the db by a sqlite file.
+
+Reports hashes/sec, loop overhead (wall time not spent waiting for
+alerts) and peak memory. Options not known here go to resolver.py,
+e.g. -threads 1000 -timeout 5 -aged 8.
+With -sizes every size runs in its own process, so memory is per size.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import resource
+import subprocess
+import tracemalloc
+import queue
+import fake_libtorrent
+
+sys.modules['libtorrent'] = fake_libtorrent
+import resolver     # pylint: disable=wrong-import-position
+import db_sink      # pylint: disable=wrong-import-position
+import prefetch     # pylint: disable=wrong-import-position
+
+VERSION = "0.0.1"
+
+
+def make_db(filename: str, swarm: fake_libtorrent.Swarm, hashes: int):
+    conn = sqlite3.connect(filename)
+    conn.executescript('pragma journal_mode = wal;'
+                       'create table torrents (id integer primary key, name, infohash, '
+                       'numfiles, size, added, truename);'
+                       'create unique index torrents_infohash on torrents (infohash);'
+                       'create table files (size, name, parenttorrentid);'
+                       'create index files_parent on files (parenttorrentid);'
+                       'create table hashes_to_resolve (id integer primary key, infohash);'
+                       'create table old_hashes_to_resolve (id integer primary key, '
+                       'infohash, runtime);')
+    torrents = []
+    queued = []
+    for idx in range(hashes):
+        info = fake_libtorrent.make_info(idx, files=1 + idx % args.files)
+        hexhash = swarm.add(info)
+        truename = ''
+        if idx % 100 < args.resolved * 100:    # metadata in db already
+            truename = info['name']
+        torrents.append((idx + 1, info['name'], hexhash, 0, 0, 0, truename))
+        queued.append((idx + 1, hexhash))
+    conn.executemany('insert into torrents values (?, ?, ?, ?, ?, ?, ?)', torrents)
+    conn.executemany('insert into hashes_to_resolve values (?, ?)', queued)
+    conn.commit()
+    conn.close()
+
+
+def run(hashes: int, resolver_argv: list):
+    swarm = fake_libtorrent.Swarm(args.resolvable, args.mu, args.sigma, args.seed)
+    fake_libtorrent.SWARM = swarm
+    tmpdir = tempfile.TemporaryDirectory()
+    db_file = os.path.join(tmpdir.name, 'bench.db')
+    start = time.perf_counter()
+    make_db(db_file, swarm, hashes)
+    print('db with {} hashes built in {:.1f}s'.format(hashes, time.perf_counter() - start))
+
+    def connect():
+        return sqlite3.connect(db_file, timeout=60)
+
+    # every hash gets exactly one session, offloaded ones are not refetched
+    resolver.args = resolver.parse_args(
+        ['-spawntime', '0', '-state', '', '-maxold', '0',
+         '-known', os.path.join(tmpdir.name, 'known.bloom'),
+         '-journal', os.path.join(tmpdir.name, 'resolver.journal'),
+         '-peercache', os.path.join(tmpdir.name, 'peers.db')] + resolver_argv)
+    resolver.logger = resolver.make_logger()
+    resolver.connect_db = connect
+
+    committed = queue.Queue()
+    writer = db_sink.DbWriter(connect, queue.Queue(maxsize=resolver.args.writer_queue),
+                              max_rows=resolver.args.batch_rows,
+                              max_delay=resolver.args.batch_time, dbtype='sqlite3',
+                              store=resolver.make_store(), committed=committed)
+    writer.start()
+    prefetcher = prefetch.Prefetcher(connect, dbtype='sqlite3',
+                                     known_file=resolver.args.known_file)
+    prefetcher.start()
+    a_resolver = resolver.Resolver(writer, prefetcher, committed,
+                                   a_journal=resolver.make_journal(dbtype='sqlite3'))
+    a_resolver.trackers.load_from_file('trackerlist.txt')
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        a_resolver.run_loop()
+    finally:
+        writer.stop()
+        prefetcher.stop()
+    a_resolver.journal.close()
+    if a_resolver.peer_cache is not None:
+        a_resolver.peer_cache.close()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    print()
+
+    done = a_resolver.count.value_of('resolved') + a_resolver.count.value_of('offloaded')
+    overhead = elapsed - a_resolver.lt_session.slept
+    print('hashes {}, resolved {}, offloaded {}, known and skipped {}'.format(
+        hashes, a_resolver.count.value_of('resolved'), a_resolver.count.value_of('offloaded'),
+        hashes - done))
+    print('wall {:.2f}s, cpu {:.2f}s, {:.1f} hashes/s'.format(elapsed, cpu, done / elapsed))
+    print('loop overhead {:.2f}s, {:.1f}us per hash'.format(overhead, overhead / max(done, 1) * 1e6))
+    if args.tracemalloc:
+        print('python peak memory {:.1f}MiB'.format(tracemalloc.get_traced_memory()[1] / 2**20))
+    # ru_maxrss is KiB on linux
+    print('max rss {:.1f}MiB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    tmpdir.cleanup()
+
+
+def main(resolver_argv: list):
+    if not args.sizes:
+        run(args.hashes, resolver_argv)
+        return
+    for size in args.sizes.split(','):
+        argv = [sys.executable, __file__, '-hashes', size]
+        argv += sys.argv[1:]
+        idx = argv.index('-sizes')
+        del argv[idx:idx + 2]
+        subprocess.run(argv, check=True)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Resolver benchmark on a simulated session')
+    parser.add_argument('-hashes', dest='hashes', default=10000, type=int,
+                        help='hashes queued in db')
+    parser.add_argument('-sizes', dest='sizes', default='', type=str,
+                        help='comma separated hash counts, each run in own process')
+    parser.add_argument('-resolvable', dest='resolvable', default=0.8, type=float,
+                        help='fraction of hashes whose metadata ever arrives')
+    parser.add_argument('-mu', dest='mu', default=0.0, type=float,
+                        help='lognormal mu of seconds to metadata')
+    parser.add_argument('-sigma', dest='sigma', default=1.0, type=float,
+                        help='lognormal sigma of seconds to metadata')
+    parser.add_argument('-resolved', dest='resolved', default=0.0, type=float,
+                        help='fraction of queued hashes with metadata in db already')
+    parser.add_argument('-files', dest='files', default=3, type=int,
+                        help='synthetic torrents have 1 to this many files')
+    parser.add_argument('-seed', dest='seed', default=1, type=int,
+                        help='random seed of the swarm')
+    parser.add_argument('-tracemalloc', dest='tracemalloc', default=False, action='store_true',
+                        help='also report python heap peak, slows the run')
+    parser.add_argument('--version', action='version', version=VERSION)
+    args, rest = parser.parse_known_args()
+
+    main(rest)
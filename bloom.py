@@ -0,0 +1,82 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import math
+import os
+import struct
+
+MAGIC = b'BLM1'
+HEADER = struct.Struct('<4sQQQd')   # magic, bits, hashes, count, error rate
+
+
+class BloomFilter:
+    """ Set of infohashes with false positives but no false negatives.
+        Infohashes are sha1 already, the bit positions are taken from
+        their bytes by double hashing instead of hashing again.
+        Sized for capacity entries at error_rate, past capacity the
+        false positive rate grows, is_full() tells when to rebuild.
+    """
+
+    def __init__(self, capacity: int, error_rate=0.01) -> None:
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, hexhash: str):
+        digest = bytes.fromhex(hexhash)
+        first, second = struct.unpack_from('<QQ', digest)
+        second |= 1
+        for i in range(self.num_hashes):
+            yield (first + i * second) % self.num_bits
+
+    def add(self, hexhash: str):
+        for pos in self.positions(hexhash):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, hexhash: str) -> bool:
+        for pos in self.positions(hexhash):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self) -> int:
+        return self.count
+
+    def is_full(self) -> bool:
+        return self.count > self.capacity
+
+    def save(self, file_name: str):
+        tmp_name = file_name + '.tmp'
+        with open(tmp_name, 'wb') as f_h:
+            f_h.write(HEADER.pack(MAGIC, self.num_bits, self.num_hashes, self.count,
+                                  self.error_rate))
+            f_h.write(self.bits)
+        os.replace(tmp_name, file_name)
+
+    @classmethod
+    def load(cls, file_name: str):
+        """ Filter saved to file_name, None if missing or not a filter """
+        if not file_name or not os.path.exists(file_name):
+            return None
+        with open(file_name, 'rb') as f_h:
+            header = f_h.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            magic, num_bits, num_hashes, count, error_rate = HEADER.unpack(header)
+            bits = f_h.read()
+        if magic != MAGIC or len(bits) != (num_bits + 7) // 8:
+            return None
+        a_filter = cls.__new__(cls)
+        a_filter.num_bits = num_bits
+        a_filter.num_hashes = num_hashes
+        a_filter.error_rate = error_rate
+        a_filter.capacity = max(1, int(-num_bits * math.log(2) ** 2 / math.log(error_rate)))
+        a_filter.bits = bytearray(bits)
+        a_filter.count = count
+        return a_filter
@@ -0,0 +1,135 @@
+#!/usr/bin/env python -u
+"""
+Exercises the lease protocol of leases.Leases against a SQLite stand-in
+of the queue tables, two owners on their own connections like two nodes.
+
+    claim       owners get disjoint rows, together all of them
+    renew       renewed leases are not taken over after their first expiry
+    reclaim     leases of an owner that stopped renewing go to the other
+    release     released rows are free again at once
+
+Exits with an assertion error on the first check that fails.
+"""
+
+import os
+import time
+import sqlite3
+import tempfile
+import leases
+
+VERSION = "0.0.1"
+
+
+def make_db(path: str, rows: int):
+    conn = sqlite3.connect(path)
+    conn.executescript('create table hashes_to_resolve (id integer primary key, infohash, '
+                       'lease_owner, lease_expires);'
+                       'create table old_hashes_to_resolve (id integer primary key, infohash, '
+                       'runtime, lease_owner, lease_expires);')
+    conn.executemany('insert into hashes_to_resolve (id, infohash) values (?, ?)',
+                     [(i, '{:040x}'.format(i)) for i in range(1, rows + 1)])
+    conn.executemany('insert into old_hashes_to_resolve (id, infohash, runtime) '
+                     'values (?, ?, ?)',
+                     [(i, '{:040x}'.format(i), (i * 7) % rows) for i in range(1, rows + 1)])
+    conn.commit()
+    conn.close()
+
+
+class Node:
+    def __init__(self, path: str, owner: str, duration: float):
+        self.conn = sqlite3.connect(path)
+        self.cursor = self.conn.cursor()
+        self.leases = leases.Leases(owner, duration, dbtype='sqlite3')
+
+    def claim_new(self, limit: int) -> set:
+        rows = self.leases.claim(self.cursor, 'hashes_to_resolve', 'id, infohash', 'id', limit)
+        self.conn.commit()
+        return {row[0] for row in rows}
+
+    def claim_old(self, limit: int) -> list:
+        rows = self.leases.claim(self.cursor, 'old_hashes_to_resolve', 'id, infohash, runtime',
+                                 'runtime asc', limit)
+        self.conn.commit()
+        return rows
+
+    def renew(self):
+        self.leases.renew(self.cursor)
+        self.conn.commit()
+
+    def release(self):
+        self.leases.release_all(self.cursor)
+        self.conn.commit()
+
+
+def check_claim(node_a: Node, node_b: Node, rows: int):
+    half = rows // 2
+    got_a = node_a.claim_new(half)
+    got_b = node_b.claim_new(rows)
+    assert len(got_a) == half, got_a
+    assert not got_a & got_b, got_a & got_b
+    assert got_a | got_b == set(range(1, rows + 1))
+    assert not node_a.claim_new(rows), 'claimed rows leased by the other owner'
+
+    old = node_a.claim_old(half)
+    runtimes = [row[2] for row in old]
+    assert runtimes == sorted(runtimes), runtimes
+    assert not {row[0] for row in old} & {row[0] for row in node_b.claim_old(rows)}
+    print('claim    ok, {} and {} rows, disjoint'.format(len(got_a), len(got_b)))
+
+
+def check_renew(node_a: Node, node_b: Node, duration: float):
+    # a renews past its first expiry, b keeps its own leases alive too
+    for _ in range(3):
+        time.sleep(duration / 2)
+        node_a.renew()
+        node_b.renew()
+    assert not node_b.claim_new(1000), 'renewed leases were taken over'
+    assert not node_a.claim_new(1000), 'renewed leases were taken over'
+    print('renew    ok, nothing free after {:.1f}s'.format(duration * 1.5))
+
+
+def check_reclaim(node_a: Node, node_b: Node, duration: float, rows: int):
+    # a dies, b lives on
+    deadline = time.time() + duration * 1.5
+    while time.time() < deadline:
+        time.sleep(duration / 3)
+        node_b.renew()
+    got_b = node_b.claim_new(rows)
+    assert len(got_b) == rows // 2, len(got_b)
+    assert not node_b.claim_new(rows)
+    print('reclaim  ok, {} expired rows taken over'.format(len(got_b)))
+
+
+def check_release(node_a: Node, node_b: Node, rows: int):
+    node_b.release()
+    got_a = node_a.claim_new(rows)
+    assert got_a == set(range(1, rows + 1)), len(got_a)
+    print('release  ok, {} rows free again'.format(len(got_a)))
+
+
+def main():
+    tmpdir = tempfile.TemporaryDirectory()
+    path = os.path.join(tmpdir.name, 'queue.db')
+    make_db(path, args.rows)
+    node_a = Node(path, 'node-a', args.duration)
+    node_b = Node(path, 'node-b', args.duration)
+    check_claim(node_a, node_b, args.rows)
+    check_renew(node_a, node_b, args.duration)
+    check_reclaim(node_a, node_b, args.duration, args.rows)
+    check_release(node_a, node_b, args.rows)
+    node_a.conn.close()
+    node_b.conn.close()
+    tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Check lease claiming against a SQLite stand-in')
+    parser.add_argument('-rows', dest='rows', default=100, type=int,
+                        help='rows in each queue table')
+    parser.add_argument('-duration', dest='duration', default=1.0, type=float,
+                        help='lease duration in seconds')
+    parser.add_argument('--version', action='version', version=VERSION)
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import json
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LIMIT = metrics.registry.gauge(
+    'resolver_concurrency_limit', 'concurrent jobs allowed by the controller')
+SPAWN_INTERVAL = metrics.registry.gauge(
+    'resolver_spawn_interval_seconds', 'min time between spawns set by the controller')
+DECISIONS = metrics.registry.counter(
+    'resolver_concurrency_decisions_total', 'controller decisions by action and reason')
+
+
+class Controller:
+    """ AIMD controller of concurrent jobs and spawn interval.
+        Once per interval the resolve rate is compared with the previous
+        interval. While it holds up and the limit was actually used the
+        limit grows by step and the spawn interval halves. If the rate
+        dropped right after an increase the step is taken back, a drop
+        without an increase is the network and leaves the limit alone.
+        When the process is overloaded (cpu, alert backlog, peer
+        connections, db writer behind) the limit is cut by backoff and
+        the spawn interval doubles.
+        Every decision is appended as a json line to log_file.
+    """
+
+    def __init__(self, limit: int, min_limit: int, max_limit: int, spawn: float,
+                 max_spawn=1.0, interval=10.0, step=0, backoff=0.7, tolerance=0.1,
+                 cpu_target=0.9, max_backlog=500, max_connections=450, log_file='') -> None:
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        self.min_spawn = spawn
+        self.max_spawn = max(spawn, max_spawn)
+        self.spawn = spawn
+        self.interval = interval
+        self.step = step or max(1, self.limit // 10)
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.cpu_target = cpu_target
+        self.max_backlog = max_backlog
+        self.max_connections = max_connections
+        self.log_file = log_file
+
+        self.started = None     # (wall, cpu, resolved) at start of interval
+        self.last_rate = None
+        self.last_action = ''
+        self.peak_running = 0
+        self.peak_backlog = 0
+        LIMIT.set(self.limit)
+        SPAWN_INTERVAL.set(self.spawn)
+
+    def note(self, running: int, backlog: int):
+        """ Called every loop iteration, keeps the peaks of the interval """
+        self.peak_running = max(self.peak_running, running)
+        self.peak_backlog = max(self.peak_backlog, backlog)
+
+    def is_due(self, now: float) -> bool:
+        return self.started is None or now >= self.started[0] + self.interval
+
+    def overload(self, cpu: float, connections: int, writer_behind: bool) -> str:
+        if writer_behind:
+            return 'writer'
+        if cpu > self.cpu_target:
+            return 'cpu'
+        if self.peak_backlog > self.max_backlog:
+            return 'alerts'
+        if connections > self.max_connections:
+            return 'connections'
+        return ''
+
+    def update(self, now: float, cpu_time: float, resolved: int, connections: int,
+               writer_behind: bool) -> None:
+        """ resolved and cpu_time are running totals, connections the
+            current peer count of all jobs
+        """
+        if self.started is None:
+            self.started = (now, cpu_time, resolved)
+            return
+        elapsed = now - self.started[0]
+        if elapsed <= 0:
+            return
+        rate = (resolved - self.started[2]) / elapsed
+        cpu = (cpu_time - self.started[1]) / elapsed
+
+        dropped = self.last_rate is not None and rate < self.last_rate * (1 - self.tolerance)
+        reason = self.overload(cpu, connections, writer_behind)
+        if reason:
+            action = 'backoff'
+        elif self.peak_running < self.limit:
+            # limit not reached, queue or spawn interval held jobs back,
+            # a rate change says nothing about the limit
+            action, reason = 'hold', 'unused'
+        elif dropped and self.last_action == 'increase':
+            action, reason = 'decrease', 'rate'
+        elif dropped:
+            action, reason = 'hold', 'rate'
+        else:
+            action, reason = 'increase', 'rate'
+
+        if action == 'backoff':
+            self.limit = max(self.min_limit, int(self.limit * self.backoff))
+            self.spawn = min(self.max_spawn, max(self.spawn * 2, self.min_spawn, 0.001))
+        elif action == 'decrease':
+            self.limit = max(self.min_limit, self.limit - self.step)
+        elif action == 'increase':
+            self.limit = min(self.max_limit, self.limit + self.step)
+            self.spawn = max(self.min_spawn, self.spawn / 2)
+
+        self.log_decision({'time': round(now, 3), 'action': action, 'reason': reason,
+                           'limit': self.limit, 'spawn': round(self.spawn, 4),
+                           'rate': round(rate, 3), 'last_rate': self.last_rate and
+                           round(self.last_rate, 3), 'cpu': round(cpu, 3),
+                           'running': self.peak_running, 'backlog': self.peak_backlog,
+                           'connections': connections, 'writer_behind': writer_behind})
+        LIMIT.set(self.limit)
+        SPAWN_INTERVAL.set(self.spawn)
+        DECISIONS.inc(action=action, reason=reason)
+
+        self.started = (now, cpu_time, resolved)
+        self.last_rate = rate
+        self.last_action = action
+        self.peak_running = 0
+        self.peak_backlog = 0
+
+    def log_decision(self, decision: dict) -> None:
+        logger.info('concurrency %s (%s): limit %s, spawn %.3fs, %.2f resolved/s',
+                    decision['action'], decision['reason'], decision['limit'],
+                    decision['spawn'], decision['rate'])
+        if not self.log_file:
+            return
+        with open(self.log_file, 'a', encoding='utf-8') as f_h:
+            f_h.write(json.dumps(decision) + '\n')
@@ -0,0 +1,333 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import logging
+import queue
+import threading
+import time
+import my_torrent_stuff
+import metrics
+import db_util
+
+logger = logging.getLogger(__name__)
+
+FLUSH_LATENCY = metrics.registry.histogram(
+    'resolver_db_flush_seconds', 'time of one write-behind flush')
+FLUSH_ROWS = metrics.registry.histogram(
+    'resolver_db_flush_rows', 'results written by one flush',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+FLUSH_ERRORS = metrics.registry.counter(
+    'resolver_db_flush_errors_total', 'failed flushes, retried on a new connection')
+RETRY_DELAY = 0.5       # seconds before the first retry, doubles up to MAX_RETRY_DELAY
+MAX_RETRY_DELAY = 30
+
+
+class DbSink:
+    """ Write-behind buffer for resolver results.
+        Resolved torrents and offloaded hashes are collected and written
+        with executemany in a single transaction once max_rows are pending
+        or the oldest pending row waited max_delay seconds.
+    """
+
+    def __init__(self, conn, max_rows=50, max_delay=0.5, dbtype="mysql", on_commit=None,
+                 leases=False):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.dbtype = dbtype
+        # called with hexhashes of every committed batch
+        self.on_commit = on_commit
+        # queue tables carry lease columns, offloaded rows give up their lease
+        self.leases = leases
+
+        self.resolved = []          # [job_id, hexhash, was_new, torrent]
+        self.offloaded_new = []     # [job_id, hexhash, runtime]
+        self.offloaded_old = []     # [total_runtime, job_id, hexhash]
+        self.oldest_pending = 0
+
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.last_batch_size = 0
+        self.last_flush_latency = 0
+
+    def pending(self) -> int:
+        return len(self.resolved) + len(self.offloaded_new) + len(self.offloaded_old)
+
+    def mark_pending(self):
+        if not self.oldest_pending:
+            self.oldest_pending = time.monotonic()
+
+    def add_resolved(self, job_id, hexhash, was_new, torrent):
+        hexhash = hexhash.lower()   # infohash columns hold lowercase hex
+        self.mark_pending()
+        self.resolved.append([job_id, hexhash, was_new, torrent])
+
+    def add_offloaded(self, job_id, hexhash, was_new, runtime):
+        hexhash = hexhash.lower()
+        self.mark_pending()
+        if was_new:
+            self.offloaded_new.append([job_id, hexhash, runtime])
+        else:
+            self.offloaded_old.append([runtime, job_id, hexhash])
+
+    def is_due(self) -> bool:
+        if not self.oldest_pending:
+            return False
+        return self.pending() >= self.max_rows or \
+            time.monotonic() > self.oldest_pending + self.max_delay
+
+    def maybe_flush(self):
+        if self.is_due():
+            self.flush()
+
+    def flush(self):
+        """ Writes everything pending in one transaction, on error the
+            transaction is rolled back by the caller and the buffers are
+            kept for a retry
+        """
+        batch_size = self.pending()
+        if not batch_size:
+            return
+        start = time.monotonic()
+
+        torrent_rows = []
+        new_deletes = []
+        old_deletes = []
+        torrents = []
+        for row in self.resolved:
+            torrents.append(row[3])
+        found = my_torrent_stuff.get_db_info_many(torrents, self.cursor, dbtype=self.dbtype)
+        for torrent in found:
+            torrent_rows.append(torrent.db_update_row())
+            torrent.update_files_db(self.cursor, dbtype=self.dbtype)
+        if len(found) < len(torrents):
+            logger.warning('%s resolved hashes not in torrents table', len(torrents) - len(found))
+
+        for job_id, hexhash, was_new, _ in self.resolved:
+            if was_new:
+                new_deletes.append((job_id, hexhash))
+            else:
+                old_deletes.append((job_id, hexhash))
+
+        if torrent_rows:
+            query = 'update torrents '\
+                    'set truename = %s, numfiles = %s '\
+                    'where id = %s '
+            self.cursor.executemany(db_util.query(query, self.dbtype), torrent_rows)
+
+        for job_id, hexhash, _ in self.offloaded_new:
+            new_deletes.append((job_id, hexhash))
+        if new_deletes:
+            query = 'delete from hashes_to_resolve '\
+                    'where id = (%s) and infohash = (%s) '
+            self.cursor.executemany(db_util.query(query, self.dbtype), new_deletes)
+        if old_deletes:
+            query = 'delete from old_hashes_to_resolve '\
+                    'where id = (%s) and infohash = (%s) '
+            self.cursor.executemany(db_util.query(query, self.dbtype), old_deletes)
+
+        if self.offloaded_new:
+            query = 'insert into old_hashes_to_resolve '\
+                    '(id, infohash, runtime) '\
+                    'values (%s, %s, %s)'
+            self.cursor.executemany(db_util.query(query, self.dbtype), self.offloaded_new)
+        if self.offloaded_old:
+            query = 'update old_hashes_to_resolve '\
+                    'set runtime = (%s) '\
+                    'where id = (%s) and infohash = (%s) '
+            if self.leases:
+                query = 'update old_hashes_to_resolve '\
+                        'set runtime = (%s), lease_owner = null, lease_expires = null '\
+                        'where id = (%s) and infohash = (%s) '
+            self.cursor.executemany(db_util.query(query, self.dbtype), self.offloaded_old)
+
+        self.conn.commit()
+
+        if self.on_commit is not None:
+            hexhashes = []
+            for row in self.resolved:
+                hexhashes.append(row[1])
+            for row in self.offloaded_new:
+                hexhashes.append(row[1])
+            for row in self.offloaded_old:
+                hexhashes.append(row[2])
+            self.on_commit(hexhashes)
+
+        self.resolved = []
+        self.offloaded_new = []
+        self.offloaded_old = []
+        self.oldest_pending = 0
+
+        self.flushes += 1
+        self.rows_flushed += batch_size
+        self.last_batch_size = batch_size
+        self.last_flush_latency = time.monotonic() - start
+        FLUSH_LATENCY.observe(self.last_flush_latency)
+        FLUSH_ROWS.observe(batch_size)
+        logger.debug('db flush of %s rows took %.1fms',
+                     batch_size, self.last_flush_latency * 1000)
+
+    def rollback(self):
+        try:
+            self.conn.rollback()
+        except db_util.DB_ERRORS:
+            pass    # connection is gone, so is the transaction
+
+    def close(self):
+        self.flush()
+
+
+class DbWriter(threading.Thread):
+    """ Owns its own db connection and a DbSink, drains a bounded queue
+        of results so the libtorrent loop never waits on the database.
+        Messages are tuples:
+            ('resolved', job_id, hexhash, was_new, torrent)
+            ('offloaded', job_id, hexhash, was_new, runtime)
+            ('sync', threading.Event)   flush and set the event
+            ('stop',)                   flush, close and exit
+        Hexhashes of committed batches are put to committed queue if given.
+        A flush failing on a lock or a lost connection is rolled back and
+        retried on a new connection with backoff, results stay buffered
+        until a commit succeeds. Other db errors stop the writer.
+    """
+
+    def __init__(self, connect, a_queue, max_rows=50, max_delay=0.5,
+                 dbtype="mysql", store=None, committed=None, leases=False):
+        threading.Thread.__init__(self)
+        self.name = 'db writer'
+        self.connect = connect      # called on the writer thread
+        self.queue = a_queue
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.dbtype = dbtype
+        self.store = store          # torrent_store.TorrentStore for .torrent files
+        self.committed = committed
+        self.leases = leases
+        self.sink = None
+        self.conn = None
+
+    def reconnect(self):
+        """ Blocks until connected, retrying with backoff """
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except db_util.DB_ERRORS:
+                pass
+            self.conn = None
+        delay = RETRY_DELAY
+        while self.conn is None:
+            try:
+                self.conn = self.connect()
+            except (*db_util.DB_ERRORS, SystemExit):    # resolver.connect_db exits on failure
+                logger.warning('db writer cannot connect, retrying in %.1fs', delay)
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+        if self.sink is not None:
+            self.sink.conn = self.conn
+            self.sink.cursor = self.conn.cursor()
+
+    def flush(self, force=True):
+        delay = RETRY_DELAY
+        while True:
+            try:
+                if force:
+                    self.sink.flush()
+                else:
+                    self.sink.maybe_flush()
+                return
+            except db_util.DB_ERRORS as err:
+                if not db_util.is_transient(err):
+                    logger.critical('db flush of %s rows failed: %s', self.sink.pending(), err)
+                    raise
+                FLUSH_ERRORS.inc()
+                logger.warning('db flush of %s rows failed, retrying in %.1fs: %s',
+                               self.sink.pending(), delay, err)
+                self.sink.rollback()
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                self.reconnect()
+
+    def run(self):
+        self.reconnect()
+        on_commit = None
+        if self.committed is not None:
+            on_commit = self.committed.put
+        self.sink = DbSink(self.conn, max_rows=self.max_rows, max_delay=self.max_delay,
+                           dbtype=self.dbtype, on_commit=on_commit, leases=self.leases)
+        while True:
+            try:
+                item = self.queue.get(timeout=self.max_delay)
+            except queue.Empty:
+                self.flush(force=False)
+                continue
+
+            if item[0] == 'resolved':
+                _, job_id, hexhash, was_new, torrent = item
+                if self.store is not None:
+                    self.store.put(torrent.fl_hexhash, torrent.file_parts())
+                self.sink.add_resolved(job_id, hexhash, was_new, torrent)
+            elif item[0] == 'offloaded':
+                self.sink.add_offloaded(*item[1:])
+            elif item[0] == 'sync':
+                self.flush()
+                item[1].set()
+            elif item[0] == 'stop':
+                self.flush()
+                self.conn.close()
+                if self.store is not None:
+                    self.store.close()
+                return
+            else:
+                logger.error('unknown db writer message %s', item[0])
+            self.flush(force=False)
+
+    def put(self, item):
+        if not self.is_alive():
+            raise RuntimeError('db writer is not running')
+        self.queue.put(item)
+
+    def is_behind(self) -> bool:
+        return self.queue.qsize() > self.queue.maxsize // 2
+
+    def sync(self):
+        """ Blocks until everything queued so far is committed """
+        done = threading.Event()
+        self.put(('sync', done))
+        while not done.wait(1):
+            if not self.is_alive():
+                raise RuntimeError('db writer died')
+
+    def stop(self):
+        if self.is_alive():
+            self.queue.put(('stop',))
+            self.join()
+
+    def stats(self) -> tuple:   # flushes, last batch size, last flush latency
+        if self.sink is None:
+            return (0, 0, 0)
+        return (self.sink.flushes, self.sink.last_batch_size, self.sink.last_flush_latency)
+
+
+class RemoteWriter:
+    """ Stand in for DbWriter in a resolver worker process,
+        messages go to the supervisor's writer over a multiprocessing queue
+    """
+
+    def __init__(self, a_queue, maxsize: int):
+        self.queue = a_queue
+        self.maxsize = maxsize
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def is_behind(self) -> bool:
+        return self.queue.qsize() > self.maxsize // 2
+
+    def sync(self):
+        # nothing to wait for, hashes stay in flight until committed
+        return
+
+    def stats(self) -> tuple:   # writer stats are shown by the supervisor
+        return (0, 0, 0)
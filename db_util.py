@@ -0,0 +1,30 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import sqlite3
+import mysql.connector
+
+DB_ERRORS = (mysql.connector.Error, sqlite3.Error)
+# lock wait timeout, deadlock, both roll back and can be retried as is
+MYSQL_RETRY_ERRNOS = (1205, 1213)
+
+
+def is_transient(err: Exception) -> bool:
+    """ Errors worth retrying on a new connection: locks, lost connections.
+        Constraint violations and bad queries fail the same way again
+    """
+    if isinstance(err, sqlite3.OperationalError):    # locked, busy, disk i/o
+        return True
+    if isinstance(err, (mysql.connector.OperationalError, mysql.connector.InterfaceError)):
+        return True
+    return getattr(err, 'errno', None) in MYSQL_RETRY_ERRNOS
+
+
+def query(text: str, dbtype: str) -> str:
+    """ Queries are written with %s placeholders, sqlite3 wants ? """
+    if dbtype == "sqlite3":
+        return text.replace("%s", "?")
+    if dbtype == "mysql":
+        return text
+    assert False
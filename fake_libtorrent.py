@@ -0,0 +1,303 @@
+#!/usr/bin/env python -u
+"""
+Stand-in for the parts of the libtorrent python bindings resolver.py uses,
+for benchmarking the resolver without a swarm.
+
+Metadata of a hash becomes available after a latency drawn from
+Swarm.latency() while its handle is running, paused time does not count.
+Hashes unknown to the swarm, or drawn as dead, never resolve.
+"""
+
+import hashlib
+import heapq
+import itertools
+import random
+import time
+
+
+def bencode(value) -> bytes:
+    if isinstance(value, int):
+        return b'i' + str(value).encode() + b'e'
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, (bytes, bytearray)):
+        return str(len(value)).encode() + b':' + bytes(value)
+    if isinstance(value, list):
+        return b'l' + b''.join(bencode(item) for item in value) + b'e'
+    if isinstance(value, dict):
+        out = [b'd']
+        for key in sorted(value, key=lambda k: k.encode() if isinstance(k, str) else k):
+            out.append(bencode(key))
+            out.append(bencode(value[key]))
+        out.append(b'e')
+        return b''.join(out)
+    raise TypeError(type(value))
+
+
+def make_info(index: int, files=1) -> dict:
+    """ Synthetic info dict, the benchmark queues sha1 of its bencoding """
+    info = {'name': 'sim{}'.format(index), 'piece length': 16384, 'pieces': b'\0' * 20}
+    if files == 1:
+        info['length'] = index + 1
+    else:
+        info['files'] = [{'length': i + 1, 'path': ['f{}'.format(i)]} for i in range(files)]
+    return info
+
+
+def info_hash_of(info: dict) -> str:
+    return hashlib.sha1(bencode(info)).hexdigest()
+
+
+class Swarm:
+    """ What the fake network knows: info dicts by hexhash and latency model """
+
+    def __init__(self, resolvable=1.0, mu=0.0, sigma=1.0, seed=1) -> None:
+        self.infos = {}
+        self.resolvable = resolvable    # fraction of hashes with live swarm
+        self.mu = mu                    # lognormal parameters of seconds to metadata
+        self.sigma = sigma
+        self.rng = random.Random(seed)
+
+    def add(self, info: dict) -> str:
+        hexhash = info_hash_of(info)
+        self.infos[hexhash] = info
+        return hexhash
+
+    def latency(self, hexhash: str):
+        if hexhash not in self.infos or self.rng.random() >= self.resolvable:
+            return None
+        return self.rng.lognormvariate(self.mu, self.sigma)
+
+
+SWARM = Swarm()
+
+
+class alert:    # pylint: disable=invalid-name
+    class category_t:   # pylint: disable=invalid-name
+        status_notification = 1
+        error_notification = 2
+        connect_notification = 4
+        dht_operation_notification = 8
+
+
+class metadata_received_alert:  # pylint: disable=invalid-name
+    def __init__(self, handle) -> None:
+        self.handle = handle
+
+
+class peer_connect_alert:   # pylint: disable=invalid-name
+    def __init__(self, handle, endpoint: tuple) -> None:
+        self.handle = handle
+        self.endpoint = endpoint
+
+
+class dht_get_peers_reply_alert:    # pylint: disable=invalid-name
+    def __init__(self, info_hash, peers: list) -> None:
+        self.info_hash = info_hash
+        self.peer_list = peers
+
+    def peers(self) -> list:
+        return self.peer_list
+
+
+class state_update_alert:   # pylint: disable=invalid-name
+    def __init__(self, status: list) -> None:
+        self.status = status
+
+
+class sha1_hash:    # pylint: disable=invalid-name
+    def __init__(self, digest: bytes) -> None:
+        self.digest = bytes(digest)
+
+    def __str__(self) -> str:
+        return self.digest.hex()
+
+    def to_bytes(self) -> bytes:
+        return self.digest
+
+
+class add_torrent_params_flags_t:   # pylint: disable=invalid-name
+    flag_auto_managed = 0x20
+    flag_upload_mode = 0x4
+
+
+class add_torrent_params:   # pylint: disable=invalid-name
+    def __init__(self) -> None:
+        self.flags = add_torrent_params_flags_t.flag_auto_managed
+        self.save_path = ''
+        self.storage_mode = 0
+        self.max_connections = 0
+        self.info_hash = None
+        self.name = ''
+        self.trackers = []
+        self.peers = []
+
+
+def storage_mode_t(value):  # pylint: disable=invalid-name
+    return value
+
+
+def default_settings() -> dict:
+    return {}
+
+
+class torrent_info:     # pylint: disable=invalid-name
+    def __init__(self, info: dict) -> None:
+        self.info = info
+        self.raw = bencode(info)
+
+    def metadata(self) -> bytes:
+        return self.raw
+
+    def info_hash(self) -> sha1_hash:
+        return sha1_hash(hashlib.sha1(self.raw).digest())
+
+    def name(self) -> str:
+        return self.info['name']
+
+
+class torrent_status:   # pylint: disable=invalid-name
+    def __init__(self, handle) -> None:
+        self.handle = handle
+        self.info_hash = handle.hash
+        self.has_metadata = handle.ti is not None
+        self.torrent_file = handle.ti
+        self.name = handle.name
+        self.active_time = int(handle.active_time())
+        self.list_peers = 0
+        self.num_peers = 1 if handle.running_since else 0
+        self.list_seeds = 0
+        self.last_seen_complete = 0
+
+
+class peer_info:    # pylint: disable=invalid-name
+    def __init__(self, ip: tuple) -> None:
+        self.ip = ip
+
+
+class torrent_handle:   # pylint: disable=invalid-name
+    def __init__(self, a_session, params: add_torrent_params, latency) -> None:
+        self.session = a_session
+        self.hash = params.info_hash
+        self.name = params.name
+        self.tracker_list = [{'url': url} for url in params.trackers]
+        self.remaining = latency    # seconds of running time to metadata, None never
+        self.ti = None
+        self.running_since = 0
+        self.active = 0
+        self.removed = False
+        self.token = 0
+
+    def info_hash(self) -> sha1_hash:
+        return self.hash
+
+    def trackers(self) -> list:
+        return self.tracker_list
+
+    def status(self) -> torrent_status:
+        return torrent_status(self)
+
+    def torrent_file(self):
+        return self.ti
+
+    def get_peer_info(self) -> list:
+        if not self.running_since:
+            return []
+        return [peer_info(('10.0.0.{}'.format(i + 1), 6881)) for i in range(3)]
+
+    def active_time(self) -> float:
+        if self.running_since:
+            return self.active + time.monotonic() - self.running_since
+        return self.active
+
+    def resume(self):
+        if self.running_since or self.removed:
+            return
+        self.running_since = time.monotonic()
+        self.token += 1
+        if self.remaining is not None and self.ti is None:
+            self.session.schedule(self, self.running_since + self.remaining, self.token)
+            # a live swarm answers on the DHT, peers derived from the hash
+            digest = self.hash.to_bytes()
+            peers = [('10.{}.{}.{}'.format(digest[i], digest[i + 1], digest[i + 2]), 6881)
+                     for i in range(0, 9, 3)]
+            self.session.alerts.append(dht_get_peers_reply_alert(self.hash, peers))
+            self.session.alerts.append(peer_connect_alert(self, peers[0]))
+
+    def pause(self):
+        if not self.running_since:
+            return
+        ran = time.monotonic() - self.running_since
+        self.active += ran
+        if self.remaining is not None:
+            self.remaining = max(self.remaining - ran, 0)
+        self.running_since = 0
+        self.token += 1
+
+
+class session:  # pylint: disable=invalid-name
+    def __init__(self, params=None) -> None:
+        self.swarm = SWARM
+        self.handles = 0
+        self.ready = []     # heap of (time, seq, token, handle)
+        self.seq = itertools.count()
+        self.alerts = []
+        self.slept = 0      # seconds spent inside wait_for_alert
+        # running time still missing of removed handles, a hash added
+        # again goes on where it stopped instead of drawing a new latency
+        self.removed = {}
+
+    def apply_settings(self, settings: dict):
+        return
+
+    def schedule(self, handle: torrent_handle, when: float, token: int):
+        heapq.heappush(self.ready, (when, next(self.seq), token, handle))
+
+    def add_torrent(self, params: add_torrent_params) -> torrent_handle:
+        hexhash = str(params.info_hash)
+        if hexhash in self.removed:
+            latency = self.removed.pop(hexhash)
+        else:
+            latency = self.swarm.latency(hexhash)
+        self.handles += 1
+        return torrent_handle(self, params, latency)
+
+    def remove_torrent(self, handle: torrent_handle):
+        handle.pause()
+        handle.removed = True
+        if handle.ti is None:
+            self.removed[str(handle.hash)] = handle.remaining
+        self.handles -= 1
+
+    def collect(self):
+        now = time.monotonic()
+        while self.ready and self.ready[0][0] <= now:
+            _, _, token, handle = heapq.heappop(self.ready)
+            if handle.removed or token != handle.token:
+                continue
+            handle.ti = torrent_info(self.swarm.infos[str(handle.hash)])
+            self.alerts.append(metadata_received_alert(handle))
+
+    def wait_for_alert(self, miliseconds: int):
+        self.collect()
+        if self.alerts:
+            return
+        start = time.monotonic()
+        until = start + miliseconds / 1000
+        if self.ready:
+            until = min(until, self.ready[0][0])
+        if until > start:
+            time.sleep(until - start)
+        self.slept += time.monotonic() - start
+
+    def pop_alerts(self) -> list:
+        self.collect()
+        alerts = self.alerts
+        self.alerts = []
+        return alerts
+
+    def post_torrent_updates(self):
+        self.alerts.append(state_update_alert([]))
+
+    def pause(self):
+        return
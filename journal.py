@@ -0,0 +1,166 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ('spawn', 'sleep', 'wake', 'resolve', 'offload', 'commit')
+RECONCILE_CHUNK = 500   # ids per IN (...) list
+
+
+class Journal:
+    """ Append-only log of what happens to in-flight jobs, so runtime
+        accumulated in the session survives a crash.
+        Lines are 'time event hexhash id was_new runtime', runtime being
+        the total including this session. Events are buffered and written
+        with one flush and fsync per commit_interval (group commit).
+        A hash is settled once the writer committed it ('commit'),
+        anything else is pending and is put back into the queue tables
+        by reconcile() after a restart.
+    """
+
+    def __init__(self, file_name: str, commit_interval=1.0, max_size=64 << 20,
+                 fsync=True) -> None:
+        self.file_name = file_name
+        self.commit_interval = commit_interval
+        self.max_size = max_size
+        self.fsync = fsync
+        self.pending = {}       # hexhash -> [time, event, id, was_new, runtime]
+        self.buffer = []
+        self.last_commit = time.monotonic()
+        self.f_h = None
+
+    def replay(self) -> dict:
+        """ Pending hashes of the journal on disk, of a run that did not
+            end cleanly. Running jobs are credited with the time until
+            the last journaled event, when the run was still alive.
+        """
+        pending = {}
+        last_time = 0
+        if not os.path.exists(self.file_name):
+            return pending
+        with open(self.file_name, 'r', encoding='ascii') as f_h:
+            for line in f_h:
+                fields = line.split()
+                if len(fields) != 6 or not line.endswith('\n') or fields[1] not in EVENTS:
+                    continue    # torn line of a crash
+                when = float(fields[0])
+                last_time = max(last_time, when)
+                if fields[1] == 'commit':
+                    pending.pop(fields[2], None)
+                    continue
+                pending[fields[2]] = [when, fields[1], int(fields[3]), fields[4] == '1',
+                                      float(fields[5])]
+        for entry in pending.values():
+            if entry[1] in ('spawn', 'wake'):
+                entry[4] += last_time - entry[0]
+        logger.info('journal %s: %s hashes pending', self.file_name, len(pending))
+        return pending
+
+    def reconcile(self, conn, pending: dict, dbtype="mysql"):
+        """ Puts pending hashes back with their runtime in one batched pass:
+            new hashes still in hashes_to_resolve move to old_hashes_to_resolve,
+            runtime of the others is raised to the journaled one.
+            Resolved ones are only there if the write was lost, they go to
+            old hashes too and get resolved again.
+        """
+        if not pending:
+            return
+        mark = '?' if dbtype == "sqlite3" else '%s'
+        greatest = 'max' if dbtype == "sqlite3" else 'greatest'
+        cursor = conn.cursor()
+
+        new_ids = [entry[2] for entry in pending.values() if entry[3]]
+        still_new = set()
+        for start in range(0, len(new_ids), RECONCILE_CHUNK):
+            chunk = new_ids[start:start + RECONCILE_CHUNK]
+            cursor.execute('select id, infohash from hashes_to_resolve '
+                           'where id in (' + ', '.join([mark] * len(chunk)) + ')', chunk)
+            for row in cursor.fetchall():
+                still_new.add((row[0], row[1].lower()))
+
+        moves = []
+        updates = []
+        for hexhash, (_, _, job_id, _, runtime) in pending.items():
+            if (job_id, hexhash) in still_new:
+                # runtime 0 marks a hash as new, moved ones are old from now on
+                moves.append((job_id, hexhash, max(1, int(runtime))))
+            else:
+                updates.append((int(runtime), job_id, hexhash))
+        if moves:
+            cursor.executemany('delete from hashes_to_resolve '
+                               'where id = ({0}) and infohash = ({0}) '.format(mark),
+                               [row[:2] for row in moves])
+            cursor.executemany('insert into old_hashes_to_resolve '
+                               '(id, infohash, runtime) '
+                               'values ({0}, {0}, {0})'.format(mark), moves)
+        if updates:
+            cursor.executemany('update old_hashes_to_resolve '
+                               'set runtime = {1}(runtime, {0}) '
+                               'where id = ({0}) and infohash = ({0}) '.format(mark, greatest),
+                               updates)
+        conn.commit()
+        logger.info('journal reconciled: %s moved to old hashes, %s runtimes updated',
+                    len(moves), len(updates))
+
+    def open(self):
+        """ Starts a fresh journal, call after replay and reconcile """
+        self.f_h = open(self.file_name + '.tmp', 'w', encoding='ascii')
+        os.replace(self.file_name + '.tmp', self.file_name)
+        self.pending = {}
+
+    def record(self, event: str, hexhash: str, job_id: int, was_new: bool, runtime: float):
+        hexhash = hexhash.lower()
+        now = time.time()
+        self.pending[hexhash] = [now, event, job_id, was_new, runtime]
+        self.buffer.append('{:.3f} {} {} {} {} {:.1f}\n'.format(
+            now, event, hexhash, job_id, int(was_new), runtime))
+
+    def settle(self, hexhashes: list):
+        """ Hashes whose results the writer committed """
+        now = time.time()
+        for hexhash in hexhashes:
+            hexhash = hexhash.lower()
+            if self.pending.pop(hexhash, None) is not None:
+                self.buffer.append('{:.3f} commit {} 0 0 0\n'.format(now, hexhash))
+
+    def maybe_commit(self):
+        if time.monotonic() > self.last_commit + self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.last_commit = time.monotonic()
+        if not self.buffer or self.f_h is None:
+            return
+        self.f_h.writelines(self.buffer)
+        self.buffer = []
+        self.f_h.flush()
+        if self.fsync:
+            os.fsync(self.f_h.fileno())
+        if self.f_h.tell() > self.max_size:
+            self.compact()
+
+    def compact(self):
+        """ Rewrites the journal with only the pending hashes """
+        tmp_name = self.file_name + '.tmp'
+        with open(tmp_name, 'w', encoding='ascii') as f_h:
+            for hexhash, (when, event, job_id, was_new, runtime) in self.pending.items():
+                f_h.write('{:.3f} {} {} {} {} {:.1f}\n'.format(
+                    when, event, hexhash, job_id, int(was_new), runtime))
+            f_h.flush()
+            os.fsync(f_h.fileno())
+        self.f_h.close()
+        os.replace(tmp_name, self.file_name)
+        self.f_h = open(self.file_name, 'a', encoding='ascii')
+        logger.debug('journal compacted to %s hashes', len(self.pending))
+
+    def close(self):
+        """ Clean shutdown, nothing is pending once the writer synced """
+        self.commit()
+        if self.f_h is not None:
+            self.f_h.close()
+            self.f_h = None
@@ -0,0 +1,90 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import logging
+import time
+import db_util
+
+logger = logging.getLogger(__name__)
+
+# Columns needed on hashes_to_resolve and old_hashes_to_resolve:
+#   alter table hashes_to_resolve
+#       add lease_owner varchar(64) null, add lease_expires bigint null,
+#       add index lease_idx (lease_owner, lease_expires);
+#   (same for old_hashes_to_resolve)
+# lease_expires is unix time in miliseconds, null when not leased.
+
+
+class Leases:
+    """ Claim/lease protocol letting several resolver nodes share the queue tables.
+        A claim is one atomic UPDATE marking up to limit free or expired rows
+        with owner and a claim-unique expiry, the marked rows are then read
+        back by that pair. Leases are renewed while the node lives and run
+        out when it dies, so its rows are reclaimed by others.
+    """
+
+    TABLES = ('hashes_to_resolve', 'old_hashes_to_resolve')
+
+    def __init__(self, owner: str, duration=600, dbtype="mysql"):
+        self.owner = owner
+        self.duration = duration    # seconds
+        self.dbtype = dbtype
+        self.last_expires = 0
+        self.last_renew = 0
+
+    def new_expiry(self) -> int:
+        # strictly increasing, expiry doubles as the claim token
+        expires = max(int((time.time() + self.duration) * 1000), self.last_expires + 1)
+        self.last_expires = expires
+        return expires
+
+    def claim(self, cursor, table: str, columns: str, order: str, limit: int,
+              extra_sql='', extra_params=()) -> list:
+        assert table in self.TABLES
+        expires = self.new_expiry()
+        now = int(time.time() * 1000)
+        free = '(lease_expires is null or lease_expires < %s) ' + extra_sql
+        if self.dbtype == "mysql":
+            query = 'update ' + table + ' '\
+                    'set lease_owner = %s, lease_expires = %s '\
+                    'where ' + free + \
+                    'order by ' + order + ' '\
+                    'limit %s'
+        else:   # sqlite has no update ... limit by default
+            query = 'update ' + table + ' '\
+                    'set lease_owner = %s, lease_expires = %s '\
+                    'where id in (select id from ' + table + ' '\
+                    'where ' + free + \
+                    'order by ' + order + ' '\
+                    'limit %s)'
+        cursor.execute(db_util.query(query, self.dbtype),
+                       (self.owner, expires, now) + tuple(extra_params) + (limit,))
+
+        query = 'select ' + columns + ' from ' + table + ' '\
+                'where lease_owner = %s and lease_expires = %s '\
+                'order by ' + order
+        cursor.execute(db_util.query(query, self.dbtype), (self.owner, expires))
+        return cursor.fetchall()
+
+    def is_renew_due(self) -> bool:
+        return time.time() > self.last_renew + self.duration / 3
+
+    def renew(self, cursor):
+        """ Extends every lease of this owner """
+        expires = self.new_expiry()
+        for table in self.TABLES:
+            query = 'update ' + table + ' '\
+                    'set lease_expires = %s '\
+                    'where lease_owner = %s and lease_expires is not null'
+            cursor.execute(db_util.query(query, self.dbtype), (expires, self.owner))
+        self.last_renew = time.time()
+
+    def release_all(self, cursor):
+        """ On clean shutdown or restart of the same node, rows go back to the pool """
+        for table in self.TABLES:
+            query = 'update ' + table + ' '\
+                    'set lease_owner = null, lease_expires = null '\
+                    'where lease_owner = %s'
+            cursor.execute(db_util.query(query, self.dbtype), (self.owner,))
+        logger.info('released leases of %s', self.owner)
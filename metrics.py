@@ -0,0 +1,180 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import bisect
+import http.server
+import json
+import threading
+import time
+
+# seconds, fits both db flushes and time to metadata
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120)
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, helptext: str, lock) -> None:
+        self.name = name
+        self.helptext = helptext
+        self.lock = lock
+        self.values = {}    # labels tuple of (key, value) -> value
+
+    @staticmethod
+    def key(labels: dict) -> tuple:
+        if not labels:
+            return ()
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def label_text(key: tuple, extra=()) -> str:
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        parts = []
+        for name, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            parts.append('{}="{}"'.format(name, value))
+        return '{' + ','.join(parts) + '}'
+
+    def lines(self) -> list:
+        lines = []
+        for key, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(self.name, self.label_text(key), value))
+        return lines
+
+    def snapshot(self) -> list:
+        rows = []
+        for key, value in self.values.items():
+            rows.append({'labels': dict(key), 'value': value})
+        return rows
+
+
+class CounterMetric(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class GaugeMetric(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class HistogramMetric(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, helptext: str, lock, buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, helptext, lock)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # per bucket counts (not cumulative), +inf last, then sum and count
+                entry = [[0] * (len(self.buckets) + 1), 0, 0]
+                self.values[key] = entry
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def lines(self) -> list:
+        lines = []
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for idx, bound in enumerate(self.buckets + ('+Inf',)):
+                cumulative += counts[idx]
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, self.label_text(key, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self.label_text(key), total))
+            lines.append('{}_count{} {}'.format(self.name, self.label_text(key), count))
+        return lines
+
+    def snapshot(self) -> list:
+        rows = []
+        for key, (counts, total, count) in self.values.items():
+            rows.append({'labels': dict(key), 'buckets': list(self.buckets),
+                         'counts': list(counts), 'sum': total, 'count': count})
+        return rows
+
+
+class Registry:
+    """ Counters, gauges and histograms of one process,
+        rendered as Prometheus text or dumped as json lines
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def add(self, cls, name: str, helptext: str, **kwargs) -> Metric:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = cls(name, helptext, self.lock, **kwargs)
+            self.metrics[name] = metric
+        assert isinstance(metric, cls)
+        return metric
+
+    def counter(self, name: str, helptext='') -> CounterMetric:
+        return self.add(CounterMetric, name, helptext)
+
+    def gauge(self, name: str, helptext='') -> GaugeMetric:
+        return self.add(GaugeMetric, name, helptext)
+
+    def histogram(self, name: str, helptext='', buckets=DEFAULT_BUCKETS) -> HistogramMetric:
+        return self.add(HistogramMetric, name, helptext, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, metric in sorted(self.metrics.items()):
+                if metric.helptext:
+                    lines.append('# HELP {} {}'.format(name, metric.helptext))
+                lines.append('# TYPE {} {}'.format(name, metric.kind))
+                lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename: str, extra=None):
+        """ Appends one json line with every metric """
+        row = {'time': time.time()}
+        if extra:
+            row.update(extra)
+        with self.lock:
+            for name, metric in self.metrics.items():
+                row[name] = metric.snapshot()
+        with open(filename, 'a', encoding='utf-8') as f_h:
+            f_h.write(json.dumps(row) + '\n')
+
+    def serve(self, port: int) -> http.server.HTTPServer:
+        """ Prometheus text endpoint on http://0.0.0.0:port/metrics """
+        a_registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):   # pylint: disable=invalid-name
+                body = a_registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):   # pylint: disable=redefined-builtin
+                return
+
+        server = http.server.ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        return server
+
+
+registry = Registry()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python -u
+"""
+Converts infohash columns to normalized lowercase CHAR(40) with an index,
+so lookups are plain equality instead of infohash like (...).
+
+Rows are lowercased in id ranges of -batch rows, each range its own
+transaction, then the column type and index are changed. Duplicates
+(same hash in different case) are reported and stop the unique index.
+
+The trackers table gets its unique key on url, which the resolver's
+bulk upsert of tracker stats relies on. Rows of the same url, left by
+saves made without the key, are summed into one first.
+"""
+
+import os
+import sys
+import sqlite3
+import mysql.connector
+import db_util
+
+VERSION = "0.0.1"
+
+# table -> unique index wanted
+TABLES = {
+    'torrents': True,
+    'hashes_to_resolve': False,
+    'old_hashes_to_resolve': False,
+}
+
+
+def query(text: str) -> str:
+    return db_util.query(text, 'sqlite3' if args.sqlite else 'mysql')
+
+
+def mixed_case(column: str) -> str:
+    """ Condition matching values that are not lowercase. MySQL compares
+        in the column's collation, the default _ci one finds 'ABC' equal
+        to 'abc', the comparison has to be binary
+    """
+    if args.sqlite:
+        return column + ' <> lower(' + column + ')'
+    return 'binary ' + column + ' <> lower(' + column + ')'
+
+
+def lowercase_table(conn, table: str):
+    cursor = conn.cursor()
+    cursor.execute('select min(id), max(id) from ' + table)
+    low, high = cursor.fetchone()
+    if low is None:
+        logger.info('%s is empty', table)
+        return
+
+    done = 0
+    start = low
+    while start <= high:
+        cursor.execute(query('update ' + table + ' '
+                             'set infohash = lower(infohash) '
+                             'where id >= %s and id < %s and ' + mixed_case('infohash')),
+                       (start, start + args.batch))
+        done += cursor.rowcount
+        conn.commit()
+        start += args.batch
+        print('{} ids up to {} of {}, changed {}'.format(table, min(start - 1, high), high, done),
+              end='    \r')
+    print()
+
+
+def count_mixed_case(conn, table: str) -> int:
+    cursor = conn.cursor()
+    cursor.execute('select count(1) from ' + table + ' where ' + mixed_case('infohash'))
+    return cursor.fetchone()[0]
+
+
+def find_duplicates(conn, table: str) -> int:
+    cursor = conn.cursor()
+    cursor.execute('select infohash, count(1) from ' + table + ' '
+                   'group by infohash having count(1) > 1')
+    rows = cursor.fetchall()
+    for row in rows[:20]:
+        logger.warning('%s duplicate %s x%s', table, row[0], row[1])
+    return len(rows)
+
+
+def merge_trackers(conn) -> int:
+    cursor = conn.cursor()
+    cursor.execute('select url, sum(uses), sum(resolves) from trackers '
+                   'group by url having count(1) > 1')
+    rows = cursor.fetchall()
+    for url, uses, resolves in rows:
+        cursor.execute(query('delete from trackers where url = %s'), (url,))
+        cursor.execute(query('insert into trackers (uses, resolves, ratio, url) '
+                             'values (%s, %s, %s, %s)'),
+                       (uses, resolves, resolves / max(uses, 1), url))
+    conn.commit()
+    logger.info('trackers: merged rows of %s urls', len(rows))
+    return len(rows)
+
+
+def add_tracker_key(conn):
+    cursor = conn.cursor()
+    if args.sqlite:
+        cursor.execute('create unique index if not exists url_unique on trackers (url)')
+    else:
+        cursor.execute("show index from trackers where Key_name = 'url_unique'")
+        if cursor.fetchall():
+            logger.info('trackers already has url_unique')
+            return
+        cursor.execute('alter table trackers add unique key url_unique (url)')
+    conn.commit()
+    logger.info('trackers altered')
+
+
+def alter_table(conn, table: str, unique: bool):
+    cursor = conn.cursor()
+    kind = 'unique index' if unique else 'index'
+    if args.sqlite:
+        cursor.execute('create ' + kind + ' if not exists ' + table + '_infohash '
+                       'on ' + table + ' (infohash)')
+    else:
+        cursor.execute('alter table ' + table + ' '
+                       'modify infohash char(40) character set ascii collate ascii_bin not null, '
+                       'add ' + kind + ' ' + table + '_infohash (infohash)')
+    conn.commit()
+    logger.info('%s altered', table)
+
+
+def main():
+    if args.sqlite:
+        conn = sqlite3.connect(args.sqlite)
+    else:
+        try:
+            conn = mysql.connector.connect(
+                host='localhost',
+                user=os.environ.get("mysql_user"),
+                password=os.environ.get("mysql_password"),
+                database=args.database
+            )
+        except mysql.connector.Error:
+            print('Connection to db failed')
+            sys.exit()
+
+    for table, unique in TABLES.items():
+        if args.tables and table not in args.tables:
+            continue
+        lowercase_table(conn, table)
+        # a case-sensitive column would never match the remaining ones
+        remaining = count_mixed_case(conn, table)
+        if remaining:
+            logger.critical('%s still has %s mixed case hashes, not altered', table, remaining)
+            continue
+        if unique and find_duplicates(conn, table):
+            logger.critical('%s has duplicated hashes, resolve them and rerun', table)
+            continue
+        if not args.no_alter:
+            alter_table(conn, table, unique)
+
+    if not args.tables or 'trackers' in args.tables:
+        merge_trackers(conn)
+        if not args.no_alter:
+            add_tracker_key(conn)
+    conn.close()
+
+
+if __name__ == "__main__":
+    import logging
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    sh = logging.StreamHandler()
+    sh.setLevel(logging.DEBUG)
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Normalize and index infohash columns')
+
+    parser.add_argument('tables', nargs='*', type=str,
+                        help='tables to migrate, default all of '
+                             + ', '.join(list(TABLES) + ['trackers']))
+    parser.add_argument('-sqlite', dest='sqlite', default='', type=str,
+                        help='sqlite db file, default mysql from env mysql_user/mysql_password')
+    parser.add_argument('-database', dest='database', default='tpb', type=str,
+                        help='mysql database name')
+    parser.add_argument('-batch', dest='batch', default=50000, type=int,
+                        help='ids per update transaction')
+    parser.add_argument('--noalter', dest='no_alter', default=False, action='store_true',
+                        help='only lowercase the values')
+
+    parser.add_argument('--version', action='version', version=VERSION)
+    args = parser.parse_args()
+
+    main()
@@ -7,7 +7,7 @@ import sys
 import os
 import hashlib
 import datetime
-import bencode
+import array
 
 
 logger = logging.getLogger(__name__)
@@ -24,19 +24,297 @@ logger.addHandler(sh)
 
 
 TESTLEVEL = 0
+FILES_CHUNK = 1000  # rows per bulk insert into files
+LOOKUP_CHUNK = 500  # hashes or ids per IN (...) list
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def decode_string(data: bytes, pos: int, raw=False):
+    colon = data.index(b':', pos)
+    start = colon + 1
+    end = start + int(data[pos:colon])
+    if end > len(data):
+        raise BencodeError('string past end of data at {}'.format(pos))
+    if raw:
+        return memoryview(data)[start:end], end
+    value = data[start:end]
+    try:
+        return value.decode('utf-8'), end
+    except UnicodeDecodeError:
+        return value, end
+
+
+def decode_value(data: bytes, pos: int):
+    """ Decodes the value at pos, returns it and the position after it.
+        Strings are str if valid utf-8, bytes otherwise, like the bencode package
+    """
+    char = data[pos]
+    if char == 0x69:            # i
+        end = data.index(b'e', pos)
+        return int(data[pos + 1:end]), end + 1
+    if char == 0x6c:            # l
+        pos += 1
+        items = []
+        while data[pos] != 0x65:
+            item, pos = decode_value(data, pos)
+            items.append(item)
+        return items, pos + 1
+    if char == 0x64:            # d
+        pos += 1
+        items = {}
+        while data[pos] != 0x65:
+            key, pos = decode_string(data, pos)
+            items[key], pos = decode_value(data, pos)
+        return items, pos + 1
+    return decode_string(data, pos)
+
+
+def skip_value(data: bytes, pos: int) -> int:
+    """ Position after the value at pos, nothing is decoded """
+    char = data[pos]
+    if char == 0x69:
+        return data.index(b'e', pos) + 1
+    if char in (0x6c, 0x64):
+        pos += 1
+        while data[pos] != 0x65:
+            pos = skip_value(data, pos)
+        return pos + 1
+    colon = data.index(b':', pos)
+    return colon + 1 + int(data[pos:colon])
+
+
+class LazyDict:
+    """ Bencoded dict decoded on access.
+        Construction only records the byte span of every value, a value is
+        decoded when read. span() gives the exact bytes of a value, so the
+        infohash is sha1 of what was received, canonical or not.
+        Keys in RAW_KEYS come back as memoryview into data, not copied.
+    """
+    RAW_KEYS = ('pieces',)
+
+    def __init__(self, data: bytes, start=0) -> None:
+        self.data = data
+        self.spans = {}
+        self.values = {}
+        try:
+            if data[start] != 0x64:
+                raise BencodeError('not a dict at {}'.format(start))
+            pos = start + 1
+            while data[pos] != 0x65:
+                key, pos = decode_string(data, pos)
+                end = skip_value(data, pos)
+                self.spans[key] = (pos, end)
+                pos = end
+        except (IndexError, ValueError) as err:
+            raise BencodeError(str(err)) from err
+        self.end = pos + 1
+
+    def __contains__(self, key) -> bool:
+        return key in self.spans
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        start, _ = self.spans[key]
+        try:
+            if key in self.RAW_KEYS and self.data[start] != 0x64:
+                value, _ = decode_string(self.data, start, raw=True)
+            else:
+                value, _ = decode_value(self.data, start)
+        except (IndexError, ValueError) as err:
+            raise BencodeError(str(err)) from err
+        self.values[key] = value
+        return value
+
+    def get(self, key, default=None):
+        if key in self.spans:
+            return self[key]
+        return default
+
+    def keys(self):
+        return self.spans.keys()
+
+    def span(self, key) -> memoryview:
+        start, end = self.spans[key]
+        return memoryview(self.data)[start:end]
+
+    def lazy(self, key) -> 'LazyDict':
+        """ Nested dict, decoded on access as well """
+        return LazyDict(self.data, self.spans[key][0])
+
+
+def text_of(value) -> str:
+    if isinstance(value, (bytes, bytearray)):
+        try:
+            return value.decode("utf-8")
+        except UnicodeDecodeError:
+            return "utf-8 decode error"
+    return value
+
+
+class TorrentRecord:
+    """ Immutable torrent, the raw info dict and what is derived from it.
+        data holds either a whole .torrent file or just the info dict,
+        info is the span [start, end) of data. Name, size, file list and
+        piece hashes are decoded on first use and cached. The file list
+        is column-wise: sizes in an array, paths as tuples of interned
+        components. Pickles as the info bytes only.
+    """
+    __slots__ = ('data', 'start', 'end', 'hexhash',
+                 '_name', '_sizes', '_paths', '_pieces')
+
+    def __init__(self, data: bytes, start=0, end=None, hexhash=None) -> None:
+        if end is None:
+            end = len(data)
+        setter = object.__setattr__
+        setter(self, 'data', data)
+        setter(self, 'start', start)
+        setter(self, 'end', end)
+        if hexhash is None:
+            hexhash = hashlib.sha1(self.info_bytes).hexdigest()
+        setter(self, 'hexhash', hexhash)
+
+    @classmethod
+    def from_torrent_file(cls, torfile: bytes) -> 'TorrentRecord':
+        """ Record over a .torrent file, hashed on the info bytes as stored """
+        start, end = LazyDict(torfile).spans['info']
+        return cls(torfile, start, end)
+
+    @classmethod
+    def from_files(cls, name: str, files: list, hexhash: str) -> 'TorrentRecord':
+        """ Record without info bytes, for tools building torrents by hand.
+            files is [(size, [path components])]
+        """
+        record = cls(b'', hexhash=hexhash)
+        record.cache('_name', name)
+        record.cache('_sizes', array.array('q', [size for size, _ in files]))
+        record.cache('_paths', tuple(tuple(sys.intern(item) for item in path)
+                                     for _, path in files))
+        return record
+
+    def __setattr__(self, name, value):
+        raise AttributeError('TorrentRecord is immutable')
+
+    def __reduce__(self):
+        if not self.data:
+            return (TorrentRecord.from_files,
+                    (self.name, list(zip(self.sizes, self.paths)), self.hexhash))
+        info = self.data
+        if self.start != 0 or self.end != len(self.data):
+            info = bytes(self.info_bytes)
+        return (TorrentRecord, (info, 0, None, self.hexhash))
+
+    def cache(self, name: str, value):
+        object.__setattr__(self, name, value)
+        return value
+
+    @property
+    def info_bytes(self) -> memoryview:
+        return memoryview(self.data)[self.start:self.end]
+
+    def info(self) -> LazyDict:
+        return LazyDict(self.data, self.start)
+
+    def file_parts(self) -> list:
+        """ .torrent file contents, bare info is wrapped in a dict
+            without copying it
+        """
+        if self.start == 0 and self.end == len(self.data):
+            return [b'd4:info', self.data, b'e']
+        return [self.data]
+
+    @property
+    def name(self) -> str:
+        try:
+            return self._name
+        except AttributeError:
+            return self.cache('_name', text_of(self.info()['name']))
+
+    def decode_files(self):
+        info = self.info()
+        if 'files' in info:         # yield pieces from a multi-file torrent
+            sizes = array.array('q')
+            paths = []
+            for file in info['files']:
+                sizes.append(file['length'])
+                paths.append(tuple(sys.intern(item) if isinstance(item, str) else item
+                                   for item in file['path']))
+        else:                           # yield pieces from a single file torrent
+            sizes = array.array('q', [info['length']])
+            paths = [(info['name'],)]
+        self.cache('_sizes', sizes)
+        self.cache('_paths', tuple(paths))
+
+    def decode(self):
+        """ Name and file list decoded now, a broken info dict fails here
+            instead of wherever they are first used. Pieces stay lazy
+        """
+        self.decode_files()
+        self.cache('_name', text_of(self.info()['name']))
+
+    @property
+    def sizes(self) -> array.array:
+        try:
+            return self._sizes
+        except AttributeError:
+            self.decode_files()
+            return self._sizes
+
+    @property
+    def paths(self) -> tuple:
+        try:
+            return self._paths
+        except AttributeError:
+            self.decode_files()
+            return self._paths
+
+    @property
+    def num_files(self) -> int:
+        return len(self.sizes)
+
+    @property
+    def size(self) -> int:
+        return sum(self.sizes)
+
+    @property
+    def pieces(self) -> memoryview:
+        try:
+            return self._pieces
+        except AttributeError:
+            return self.cache('_pieces', self.info()['pieces'])
+
+    def piece_hash(self, index: int) -> memoryview:
+        return self.pieces[index * 20:index * 20 + 20]
+
+    def file_rows(self) -> list:     # [(size, name)] as stored in files table
+        rows = []
+        for size, path in zip(self.sizes, self.paths):
+            file_name = ""
+            for item in path:
+                try:
+                    file_name += item + "/"
+                except TypeError:
+                    file_name += "<TypeError>" + "/"
+
+            file_name = file_name[:-1]  # ditch the last /
+            rows.append((size, file_name))
+        return rows
 
 
 class Torrent:
+    """ Torrent as read from a file or from resolved metadata (record)
+        together with its row in db (db_*)
+    """
+    __slots__ = ('torfile', 'record',
+                 'db_name', 'db_truename', 'db_added_date', 'db_size', 'db_hexhash',
+                 'db_files', 'db_file_rows', 'db_numfiles', 'db_id')
 
     def __init__(self):
-        self.torinfo: dict
-        self.info: dict
         self.torfile = b''
-
-        self.fl_name: str
-        self.fl_size: int
-        self.fl_hexhash: str
-        self.fl_filelist = []
+        self.record: TorrentRecord
 
         self.db_name: str
         self.db_truename: str
@@ -44,18 +322,46 @@ class Torrent:
         self.db_size: int
         self.db_hexhash: str
         self.db_files = []
-        self.db_file_rows: int
+        self.db_file_rows = 0
         self.db_numfiles: int
         self.db_id: int
 
+    @property
+    def fl_name(self) -> str:
+        return self.record.name
+
+    @property
+    def fl_size(self) -> int:
+        return self.record.size
+
+    @property
+    def fl_hexhash(self) -> str:
+        return self.record.hexhash
+
+    @property
+    def fl_filelist(self) -> list:
+        """ [{'length', 'path'}] like in the info dict, built on each call """
+        return [{"length": size, "path": list(path)}
+                for size, path in zip(self.record.sizes, self.record.paths)]
+
+    @property
+    def metadata(self) -> memoryview:
+        return self.record.info_bytes
+
+    @property
+    def info(self) -> LazyDict:
+        return self.record.info()
+
+    def file_parts(self) -> list:
+        return self.record.file_parts()
+
     def save_file_to(self, dest_dir, filename=''):
         if not filename:
-            torinfo = bencode.bdecode(self.torfile)
-            filename = torinfo['info']['name'] + '.torrent'
+            filename = self.fl_name + '.torrent'
         if not os.path.exists(dest_dir):
             os.makedirs(dest_dir)
         file_h = open(os.path.join(dest_dir, filename), 'wb')
-        file_h.write(self.torfile)
+        file_h.writelines(self.file_parts())
         file_h.close()
 
     def load_torrent_file_info(self, file_name: str):
@@ -65,42 +371,36 @@ class Torrent:
         self.digest_torfile()
 
     def digest_torfile(self):
+        # hash of the info bytes as in the file, re-encoding would
+        # change it for non-canonical torrents
         try:
-            self.torinfo = bencode.bdecode(self.torfile)
-        except bencode.BencodeDecodeError:
+            self.record = TorrentRecord.from_torrent_file(self.torfile)
+            self.record.decode()
+        except (BencodeError, KeyError, TypeError):
             logger.critical('Failed to de-ben-code')
             sys.exit(0)
 
-        self.info = self.torinfo['info']
-        self.fl_name = self.info['name']
-        if isinstance(self.fl_name, (bytes, bytearray)):
-            try:
-                self.fl_name = self.fl_name.decode("utf-8")
-            except UnicodeDecodeError:
-                self.fl_name = "utf-8 decode error"
-
-        if 'files' in self.info:        # yield pieces from a multi-file torrent
-            self.fl_filelist = self.info['files']
-            self.fl_size = 0
-            for file in self.info['files']:
-                self.fl_size += file['length']
-        else:                           # yield pieces from a single file torrent
-            self.fl_filelist = [
-                {"length": self.info['length'], "path":[self.info['name']]}]
-            self.fl_size = self.info['length']
-
-        self.fl_hexhash = hashlib.sha1(bencode.bencode(self.info)).hexdigest()
+    def digest_metadata(self, metadata: bytes):
+        """ Record of the raw info dict of a resolved hash. The hash is
+            taken over the received bytes, no re-encoding
+        """
+        try:
+            self.record = TorrentRecord(metadata)
+            self.record.decode()
+        except (BencodeError, KeyError, TypeError):
+            logger.critical('Failed to de-ben-code')
+            sys.exit(0)
 
     def print_file_info(self, print_files=False):
 
         print("torrent file hash", self.fl_hexhash)
         print("torrent true name", self.fl_name)
-        print("files in torrent", len(self.fl_filelist))
+        print("files in torrent", self.record.num_files)
         print("torrent size", self.fl_size)
 
         if print_files:
-            for file in self.fl_filelist:
-                print(file['length'], file['path'])
+            for size, path in zip(self.record.sizes, self.record.paths):
+                print(size, list(path))
 
     # returns number of hash matches, always should be 1 or 0
     def get_db_info(self, cursor, dbtype="sqlite3") -> int:
@@ -111,11 +411,11 @@ class Torrent:
         if dbtype == "sqlite3":
             query = "select name, infohash, numfiles, size, added, truename, id "\
                     "from torrents "\
-                    "where infohash like (?)"
+                    "where infohash = (?)"
         elif dbtype == "mysql":
             query = "select name, infohash, numfiles, size, added, truename, id "\
                     "from torrents "\
-                    "where infohash like (%s)"
+                    "where infohash = (%s)"
         else:
             assert False
 
@@ -149,11 +449,11 @@ class Torrent:
         if dbtype == "sqlite3":
             query = "select fl.size, fl.name "\
                     "from files fl, torrents tr "\
-                    "where fl.parenttorrentid = tr.id and tr.infohash like (?)"
+                    "where fl.parenttorrentid = tr.id and tr.infohash = (?)"
         elif dbtype == "mysql":
             query = "select fl.size, fl.name "\
                     "from files fl, torrents tr "\
-                    "where fl.parenttorrentid = tr.id and tr.infohash like (%s)"
+                    "where fl.parenttorrentid = tr.id and tr.infohash = (%s)"
         else:
             assert False
 
@@ -164,6 +464,7 @@ class Torrent:
             self.db_files = rows
         else:
             self.db_file_rows = 0
+            self.db_files = []
 
         return 1
 
@@ -184,7 +485,7 @@ class Torrent:
     def is_db_info_up_to_date(self) -> bool:
         bhelper = True
         bhelper = bhelper and (self.db_truename == self.fl_name)
-        bhelper = bhelper and (len(self.fl_filelist) == self.db_numfiles)
+        bhelper = bhelper and (self.record.num_files == self.db_numfiles)
         return bhelper
 
     def update_db(self, cursor, dbtype="sqlite3") -> None:
@@ -201,48 +502,69 @@ class Torrent:
 
         if TESTLEVEL > 70:
             print(query)
-            print("args:", (self.fl_name, len(self.fl_filelist), self.db_id))
-        cursor.execute(
-            query, (self.fl_name, len(self.fl_filelist), self.db_id))
-
-        if len(self.fl_filelist) > 1 and len(self.fl_filelist) != self.db_file_rows:
-            if dbtype == "sqlite3":
-                query = "delete from files "\
-                        "where parenttorrentid = ?"
-            elif dbtype == "mysql":
-                query = "delete from files "\
-                        "where parenttorrentid = %s"
-            else:
-                assert False
+            print("args:", self.db_update_row())
+        cursor.execute(query, self.db_update_row())
+        self.update_files_db(cursor, dbtype)
+
+    # parameters of the torrents row update, for batched executemany
+    def db_update_row(self) -> tuple:
+        return (self.fl_name, self.record.num_files, self.db_id)
+
+    def fl_file_rows(self) -> list:     # [(size, name)] as stored in files table
+        return self.record.file_rows()
 
-            cursor.execute(query, (self.db_id,))
+    def update_files_db(self, cursor, dbtype="sqlite3") -> None:
+        num_files = self.record.num_files
+        if num_files <= 1 or num_files == self.db_file_rows:
+            return
 
-            if dbtype == "sqlite3":
-                query = "insert into files (size, name, parenttorrentid) values (?,?,?)"
-            elif dbtype == "mysql":
-                query = "insert into files (size, name, parenttorrentid) values (%s,%s,%s)"
+        if dbtype == "sqlite3":
+            query_delete = "delete from files "\
+                           "where parenttorrentid = ?"
+            query_insert = "insert into files (size, name, parenttorrentid) values (?,?,?)"
+        elif dbtype == "mysql":
+            query_delete = "delete from files "\
+                           "where parenttorrentid = %s"
+            query_insert = "insert into files (size, name, parenttorrentid) values (%s,%s,%s)"
+        else:
+            assert False
+
+        file_rows = self.fl_file_rows()
+        rows = None
+        if self.db_files:
+            # db list that is a part of the real one only gets the missing rows,
+            # anything else is rewritten
+            missing = {}
+            for size, name in file_rows:
+                missing[(int(size), name)] = missing.get((int(size), name), 0) + 1
+            for size, name in self.db_files:
+                key = (int(size), name)
+                if not missing.get(key, 0):
+                    break
+                missing[key] -= 1
             else:
-                assert False
+                rows = []
+                for (size, name), count in missing.items():
+                    rows.extend([(size, name, self.db_id)] * count)
 
-            for file in self.fl_filelist:
-                file_name = ""
-                for item in file['path']:
-                    try:
-                        file_name += item + "/"
-                    except TypeError:
-                        file_name += "<TypeError>" + "/"
+        if rows is None:
+            cursor.execute(query_delete, (self.db_id,))
+            rows = []
+            for size, name in file_rows:
+                rows.append((size, name, self.db_id))
 
-                file_name = file_name[:-1]  # ditch the last /
-                cursor.execute(query, (file['length'], file_name, self.db_id))
+        # mysql.connector turns executemany of an insert into multi-row inserts
+        for start in range(0, len(rows), FILES_CHUNK):
+            cursor.executemany(query_insert, rows[start:start + FILES_CHUNK])
 
     def is_truename_in_db(self, cursor, dbtype="sqlite3") -> bool:
 
         if dbtype == "sqlite3":
             query = "select truename from torrents "\
-                    "where infohash like (?)"
+                    "where infohash = (?)"
         elif dbtype == "mysql":
             query = "select truename from torrents "\
-                    "where infohash like (%s)"
+                    "where infohash = (%s)"
         else:
             assert False
 
@@ -254,3 +576,73 @@ class Torrent:
         else:
             truename_found = False
         return truename_found
+
+
+def get_db_info_many(torrents: list, cursor, dbtype="sqlite3") -> list:
+    """ get_db_info for a batch of torrents, returns those found in db.
+        One IN (...) query per table and chunk of LOOKUP_CHUNK hashes,
+        file lists are read only for torrents that may need a diff write.
+    """
+    if dbtype == "sqlite3":
+        mark = "?"
+    elif dbtype == "mysql":
+        mark = "%s"
+    else:
+        assert False
+
+    by_hash = {}
+    for a_torrent in torrents:
+        by_hash[a_torrent.fl_hexhash.lower()] = a_torrent
+    hashes = list(by_hash)
+
+    found = {}  # db id -> torrent
+    for start in range(0, len(hashes), LOOKUP_CHUNK):
+        chunk = hashes[start:start + LOOKUP_CHUNK]
+        query = "select name, infohash, numfiles, size, added, truename, id "\
+                "from torrents "\
+                "where infohash in (" + ", ".join([mark] * len(chunk)) + ")"
+        cursor.execute(query, chunk)
+        for row in cursor.fetchall():
+            a_torrent = by_hash.get(row[1].lower())
+            if a_torrent is None:
+                continue
+            if getattr(a_torrent, 'db_id', None) in found:
+                logger.critical('Multiple matches for %s', row[1])
+                continue
+            a_torrent.db_name = row[0]
+            a_torrent.db_hexhash = row[1]
+            a_torrent.db_numfiles = row[2]
+            a_torrent.db_size = int(row[3])
+            a_torrent.db_added_date = row[4]
+            a_torrent.db_truename = row[5]
+            a_torrent.db_id = row[6]
+            a_torrent.db_file_rows = 0
+            a_torrent.db_files = []
+            found[a_torrent.db_id] = a_torrent
+
+    ids = list(found)
+    needs_list = []
+    for start in range(0, len(ids), LOOKUP_CHUNK):
+        chunk = ids[start:start + LOOKUP_CHUNK]
+        query = "select parenttorrentid, count(1) "\
+                "from files "\
+                "where parenttorrentid in (" + ", ".join([mark] * len(chunk)) + ") "\
+                "group by parenttorrentid"
+        cursor.execute(query, chunk)
+        for row in cursor.fetchall():
+            a_torrent = found[row[0]]
+            a_torrent.db_file_rows = row[1]
+            # update_files_db diffs only partial lists
+            if 0 < row[1] < a_torrent.record.num_files:
+                needs_list.append(row[0])
+
+    for start in range(0, len(needs_list), LOOKUP_CHUNK):
+        chunk = needs_list[start:start + LOOKUP_CHUNK]
+        query = "select parenttorrentid, size, name "\
+                "from files "\
+                "where parenttorrentid in (" + ", ".join([mark] * len(chunk)) + ")"
+        cursor.execute(query, chunk)
+        for row in cursor.fetchall():
+            found[row[0]].db_files.append((row[1], row[2]))
+
+    return list(found.values())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import logging
+import socket
+import sqlite3
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_PEERS = 50      # peers kept per hash
+
+
+def pack_peers(endpoints) -> bytes:
+    """ (ip, port) IPv4 endpoints, 6 bytes each like compact tracker replies """
+    packed = []
+    for endpoint in endpoints:
+        try:
+            packed.append(socket.inet_aton(endpoint[0]) + struct.pack('>H', endpoint[1]))
+        except OSError:     # IPv6
+            continue
+    return b''.join(packed)
+
+
+def unpack_peers(data: bytes) -> list:
+    peers = []
+    for pos in range(0, len(data) - 5, 6):
+        peers.append((socket.inet_ntoa(data[pos:pos + 4]),
+                      struct.unpack('>H', data[pos + 4:pos + 6])[0]))
+    return peers
+
+
+class PeerCache:
+    """ Peers seen for hashes, so a hash offloaded as aged starts its
+        next try with them instead of discovering its swarm again.
+        Peers of running jobs are collected in memory (note), handed to
+        the job when it is parked (take), written to a local sqlite file
+        when the job is offloaded (store) and read when the hash is
+        spawned again (get). Entries older than max_age
+        seconds are not used and are deleted by evict().
+    """
+
+    def __init__(self, file_name: str, max_age=6 * 3600, commit_interval=5.0) -> None:
+        self.conn = sqlite3.connect(file_name)
+        self.conn.execute('create table if not exists peers '
+                          '(infohash text primary key, peers blob, updated integer)')
+        self.conn.commit()
+        self.max_age = max_age
+        self.commit_interval = commit_interval
+        self.last_commit = time.monotonic()
+        self.dirty = False
+        self.live = {}      # hexhash -> {(ip, port)} of running jobs
+
+    def note(self, hexhash: str, endpoint):
+        peers = self.live.setdefault(hexhash.lower(), set())
+        if len(peers) < MAX_PEERS:
+            peers.add((endpoint[0], endpoint[1]))
+
+    def take(self, hexhash: str) -> list:
+        """ Peers collected for hexhash, no longer kept here """
+        return list(self.live.pop(hexhash.lower(), ()))
+
+    def get(self, hexhash: str) -> list:
+        """ Cached peers of hexhash, [] if none or too old """
+        row = self.conn.execute('select peers from peers '
+                                'where infohash = ? and updated > ?',
+                                (hexhash.lower(), int(time.time() - self.max_age))).fetchone()
+        if row is None:
+            return []
+        return unpack_peers(row[0])
+
+    def store(self, hexhash: str, peers=()):
+        """ Peers collected for hexhash, plus peers, are saved for its next try """
+        hexhash = hexhash.lower()
+        endpoints = self.live.pop(hexhash, set())
+        endpoints.update(peers)
+        if not endpoints:
+            return
+        self.conn.execute('insert or replace into peers (infohash, peers, updated) '
+                          'values (?, ?, ?)',
+                          (hexhash, pack_peers(list(endpoints)[:MAX_PEERS]), int(time.time())))
+        self.dirty = True
+
+    def forget(self, hexhash: str, cached=True):
+        """ Hash resolved, its peers are of no further use,
+            cached if it may have an entry in the file
+        """
+        hexhash = hexhash.lower()
+        self.live.pop(hexhash, None)
+        if cached:
+            self.conn.execute('delete from peers where infohash = ?', (hexhash,))
+            self.dirty = True
+
+    def maybe_commit(self):
+        if self.dirty and time.monotonic() > self.last_commit + self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.dirty = False
+        self.last_commit = time.monotonic()
+
+    def evict(self):
+        cursor = self.conn.execute('delete from peers where updated <= ?',
+                                   (int(time.time() - self.max_age),))
+        self.commit()
+        logger.debug('evicted peers of %s hashes', cursor.rowcount)
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import collections
+import logging
+import queue
+import threading
+import time
+import bloom
+import metrics
+import db_util
+
+logger = logging.getLogger(__name__)
+
+KNOWN_CHECKS = metrics.registry.counter(
+    'resolver_known_filter_checks_total', 'db checks of hashes the known filter matched')
+KNOWN_CHUNK = 500           # hashes per exact check query
+KNOWN_BUILD_ROWS = 10000    # rows fetched at once while building the filter
+
+
+def is_hexhash(value) -> bool:
+    if not isinstance(value, str) or len(value) != 40:
+        return False
+    try:
+        bytes.fromhex(value)
+    except ValueError:
+        return False
+    return True
+
+
+def shard_of(hexhash: str, shards: int) -> int:
+    """ Worker owning a hash, by its first byte """
+    return int(hexhash[:2], 16) % shards
+
+
+class Prefetcher(threading.Thread):
+    """ Selects batches of hashes on its own db connection while the
+        resolver keeps running jobs.
+        request() queues a fetch, every fetch delivers exactly one batch,
+        a list of (source, [id, hexhash, runtime, session_runtime]),
+        to self.batches. An empty batch means the tables are drained.
+        Rows may still be in flight in the resolver, it filters them.
+        With shard=(index, count) only hashes of that shard are selected.
+        With leases (a leases.Leases) rows are claimed instead of selected,
+        so nodes sharing the tables never get the same hash.
+        With known_file, hashes whose metadata is in torrents already are
+        dropped from batches and deleted from their queue table. A bloom
+        filter of them, kept in known_file, screens every batch and only
+        its matches are checked in db. The filter is only touched by this
+        thread, resolved hashes wait in a deque until it merges them, and
+        it saves the filter every known_interval seconds and on stop.
+        A db error is logged and answered with an empty batch on a new
+        connection, rows whose infohash is not 40 hex digits are skipped.
+    """
+
+    def __init__(self, connect, dbtype="mysql", shard=None, leases=None, known_file='',
+                 known_interval=300):
+        threading.Thread.__init__(self)
+        self.name = 'prefetcher'
+        self.daemon = True
+        self.connect = connect      # called on the prefetcher thread
+        self.dbtype = dbtype
+        self.shard = shard
+        self.leases = leases
+        self.requests = queue.Queue()
+        self.batches = queue.Queue()
+        # leases are released on stop unless someone else does it later
+        self.release_on_stop = True
+        # new hashes are paged by id, so the ones already handed out
+        # are not selected again until the table wraps around
+        self.last_new_id = 0
+        self.known_file = known_file
+        self.known = None
+        self.known_interval = known_interval
+        self.last_known_save = time.monotonic()
+        # hexhashes resolved since the last merge into the filter
+        self.resolved = collections.deque()
+        if known_file:
+            self.known = bloom.BloomFilter.load(known_file)
+
+    def shard_filter(self) -> tuple:    # (sql condition, params)
+        if self.shard is None:
+            return '', ()
+        assert self.dbtype == "mysql"
+        index, count = self.shard
+        return 'and mod(conv(left(infohash, 2), 16, 10), %s) = %s ', (count, index)
+
+    def request(self, new_limit: int, old_limit: int, in_flight: int):
+        self.requests.put((new_limit, old_limit, in_flight))
+
+    def stop(self, release=True):
+        """ release=False leaves the leases to whoever writes the results """
+        self.release_on_stop = release
+        if self.is_alive():
+            self.requests.put(None)
+            self.join()
+
+    def build_known(self, cursor):
+        """ Filter of all hashes resolved so far, from torrents table """
+        cursor.execute("select count(1) from torrents where truename <> ''")
+        count = cursor.fetchone()[0]
+        # room to grow before the false positive rate does
+        known = bloom.BloomFilter(max(2 * count, 1 << 20))
+        cursor.execute("select infohash from torrents where truename <> ''")
+        while True:
+            rows = cursor.fetchmany(KNOWN_BUILD_ROWS)
+            if not rows:
+                break
+            for row in rows:
+                known.add(row[0].lower())
+        logger.info('known hashes filter built from %s torrents', len(known))
+        self.known = known
+        self.save_known()
+
+    def save_known(self):
+        self.merge_known()
+        if self.known_file and self.known is not None:
+            self.known.save(self.known_file)
+        self.last_known_save = time.monotonic()
+
+    def maybe_save_known(self):
+        if time.monotonic() > self.last_known_save + self.known_interval:
+            self.save_known()
+
+    def add_known(self, hexhash: str):
+        """ Called from the resolver thread, also while the filter is built """
+        if self.known_file:
+            self.resolved.append(hexhash.lower())
+
+    def merge_known(self):
+        if self.known is None:
+            return
+        while self.resolved:
+            self.known.add(self.resolved.popleft())
+
+    def drop_known(self, cursor, table: str, rows: list) -> list:
+        """ rows without hashes that are resolved already,
+            their queue rows are deleted
+        """
+        if self.known is None:
+            return rows
+        self.merge_known()
+        maybe = []
+        for row in rows:
+            if row[1].lower() in self.known:
+                maybe.append(row[1].lower())
+        if not maybe:
+            return rows
+
+        known = set()
+        for start in range(0, len(maybe), KNOWN_CHUNK):
+            chunk = maybe[start:start + KNOWN_CHUNK]
+            query = "select infohash from torrents "\
+                    "where infohash in (" + ", ".join(["%s"] * len(chunk)) + ") "\
+                    "and truename <> ''"
+            cursor.execute(db_util.query(query, self.dbtype), chunk)
+            for row in cursor.fetchall():
+                known.add(row[0].lower())
+        KNOWN_CHECKS.inc(len(known), result='known')
+        KNOWN_CHECKS.inc(len(maybe) - len(known), result='false_positive')
+        if not known:
+            return rows
+
+        kept = []
+        deletes = []
+        for row in rows:
+            if row[1].lower() in known:
+                deletes.append((row[0], row[1]))
+            else:
+                kept.append(row)
+        query = 'delete from ' + table + ' '\
+                'where id = (%s) and infohash = (%s) '
+        cursor.executemany(db_util.query(query, self.dbtype), deletes)
+        logger.debug('dropped %s known hashes from %s', len(deletes), table)
+        return kept
+
+    def valid(self, rows: list, table: str) -> list:
+        kept = []
+        for row in rows:
+            if is_hexhash(row[1]):
+                kept.append(row)
+            else:
+                logger.warning('%s id %s has malformed infohash %r', table, row[0], row[1])
+        return kept
+
+    def fetch(self, cursor, new_limit: int, old_limit: int, in_flight: int) -> list:
+        batch = []
+        while True:
+            rows = 0
+            if new_limit:
+                selected = self.valid(self.select_new(cursor, new_limit), 'hashes_to_resolve')
+                rows += len(selected)
+                for row in self.drop_known(cursor, 'hashes_to_resolve', selected):
+                    batch.append(('new', [row[0], row[1], 0, 0]))
+            if old_limit:
+                selected = self.valid(self.select_old(cursor, old_limit, in_flight),
+                                      'old_hashes_to_resolve')
+                rows += len(selected)
+                for row in self.drop_known(cursor, 'old_hashes_to_resolve', selected):
+                    batch.append(('old', [row[0], row[1], row[2], 0]))
+            # all known is not drained, empty batch would idle the resolver
+            if batch or not rows:
+                return batch
+
+    def reconnect(self, conn):
+        try:
+            conn.close()
+        except db_util.DB_ERRORS:
+            pass
+        return self.connect()
+
+    def select_new(self, cursor, limit: int) -> list:
+        shard_sql, shard_params = self.shard_filter()
+        if self.leases is not None:
+            return self.leases.claim(cursor, 'hashes_to_resolve', 'id, infohash', 'id',
+                                     limit, shard_sql, shard_params)
+
+        query = 'select id, infohash from hashes_to_resolve '\
+                'where id > %s ' + shard_sql + \
+                'order by id '\
+                'limit %s'
+        cursor.execute(db_util.query(query, self.dbtype),
+                       (self.last_new_id,) + shard_params + (limit,))
+        rows = cursor.fetchall()
+        if rows:
+            self.last_new_id = rows[-1][0]
+        if len(rows) < limit:
+            self.last_new_id = 0
+        return rows
+
+    def select_old(self, cursor, limit: int, in_flight: int) -> list:
+        shard_sql, shard_params = self.shard_filter()
+        if self.leases is not None:
+            return self.leases.claim(cursor, 'old_hashes_to_resolve', 'id, infohash, runtime',
+                                     'runtime asc', limit, shard_sql, shard_params)
+
+        # old hashes are ordered by runtime, not pageable,
+        # over-select by what may be in flight already
+        query = 'select id, infohash, runtime from old_hashes_to_resolve '\
+                'where 1 ' + shard_sql + \
+                'order by runtime asc '\
+                'limit %s'
+        cursor.execute(db_util.query(query, self.dbtype), shard_params + (limit + in_flight,))
+        return cursor.fetchall()
+
+    def run(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+        if self.known_file and (self.known is None or self.known.is_full()):
+            self.build_known(cursor)
+            conn.commit()
+        if self.leases is not None:
+            # leases left behind by a previous run of this node
+            self.leases.release_all(cursor)
+            conn.commit()
+
+        while True:
+            try:
+                timeout = None
+                if self.known_file:
+                    timeout = self.known_interval
+                if self.leases is not None:
+                    timeout = min(timeout or self.leases.duration, self.leases.duration / 3)
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                self.save_known()
+            else:
+                self.maybe_save_known()
+            try:
+                if self.leases is not None and self.leases.is_renew_due():
+                    self.leases.renew(cursor)
+                    conn.commit()
+
+                if item is None:
+                    if self.leases is not None and self.release_on_stop:
+                        self.leases.release_all(cursor)
+                        conn.commit()
+                    conn.close()
+                    return
+                if item:
+                    batch = self.fetch(cursor, *item)
+                    # commits claims, ends the read snapshot so the next select
+                    # sees the writer's commits
+                    conn.commit()
+                    logger.debug('prefetched %s rows', len(batch))
+                    self.batches.put(batch)
+            except db_util.DB_ERRORS:
+                logger.exception('prefetch failed')
+                if item is None:
+                    return
+                conn = self.reconnect(conn)
+                cursor = conn.cursor()
+                if item:
+                    # every request gets its batch, an empty one idles the resolver a while
+                    self.batches.put([])
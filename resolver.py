@@ -4,17 +4,49 @@ import os
 import sys
 import time
 import binascii
-from typing import List
-import random
+import heapq
+from typing import Dict, List
+import json
+import array
+import urllib.parse
 import tempfile
+import queue
+import multiprocessing
+import socket
 import mysql.connector
 import libtorrent
 import my_torrent_stuff
+import tracker_selection
+import scheduler
+import prefetch
+import leases
+import metrics
+import concurrency
+import db_sink
+import torrent_store
+import journal
+import peer_cache
 from pprint import PrettyPrinter
 
 VERSION = "0.0.1"
+STATUS_UPDATE_INTERVAL = 1  # seconds between post_torrent_updates() calls
+PARKED_PEERS = 8            # peers kept by a timed out job for its next try
+PEER_ALERTS = (libtorrent.peer_connect_alert, libtorrent.dht_get_peers_reply_alert)
 pp = PrettyPrinter()
 
+TIME_TO_METADATA = metrics.registry.histogram(
+    'resolver_time_to_metadata_seconds', 'running time in this session until metadata arrived')
+JOBS_ENDED = metrics.registry.counter(
+    'resolver_jobs_ended_total', 'jobs leaving the session by outcome')
+SPAWNS = metrics.registry.counter(
+    'resolver_spawns_total', 'jobs spawned or woken up by scheduler source')
+ALERTS = metrics.registry.counter(
+    'resolver_alerts_total', 'libtorrent alerts by type')
+QUEUES = metrics.registry.gauge(
+    'resolver_queue_depth', 'hashes per queue')
+TRACKER_OUTCOMES = metrics.registry.counter(
+    'resolver_tracker_announces_total', 'jobs a tracker was given to, by job outcome')
+
 class Counter:
     def __init__(self) -> None:
         self.names = ['new', 'old', 'resolved', 'offloaded']
@@ -35,31 +67,48 @@ class Job:
         self.total_runtime = 0
         self.session_runtime = 0
         self.hexhash: str
+        # last torrent_status delivered by state_update_alert
+        self.status = None
+        # seconds spent running in this session, paused time excluded
+        self.active_time = 0
+        self.run_since = 0
+        # bumped on every spawn/wake, stale deadlines are recognized by it
+        self.epoch = 0
+        self.attempts = 0  # times put to sleep after a timeout
+        self.cached_peers = 0  # peers from the peer cache it was added with
 
     def is_complete(self):
-        ret = True
-        status = self.handle.status()
-        ret = ret and status.has_metadata
+        ret = self.status is not None
+        ret = ret and self.status.has_metadata
 #        ret = ret and status.last_seen_complete > 0
 #        ret = ret and status.list_seeds > 0
 #        ret = ret and status.list_peers > 0
         return ret
 
     def has_meta(self):
-        status = self.handle.status()
-        return status.has_metadata
+        return self.status is not None and self.status.has_metadata
 
-    def is_timeout(self):
-        status = self.handle.status()
-        return status.active_time > self.session_runtime + args.timeout
+    def start_clock(self):
+        self.run_since = time.monotonic()
+        self.epoch += 1
 
-    def is_aged(self):
-        status = self.handle.status()
-        return (status.active_time) > args.aged
+    def stop_clock(self):
+        if self.run_since:
+            self.active_time += time.monotonic() - self.run_since
+            self.run_since = 0
+
+    def next_deadline(self) -> float:
+        return self.run_since + min(args.timeout, args.aged - self.active_time)
+
+    def is_timeout(self, now):
+        return now - self.run_since >= args.timeout
+
+    def is_aged(self, now):
+        return self.active_time + now - self.run_since >= args.aged
 
     def just_die(self, session_handle):
-        status = self.handle.status()
-        self.session_runtime = status.active_time
+        self.stop_clock()
+        self.session_runtime = int(self.active_time)
         session_handle.remove_torrent(self.handle)
         return
 
@@ -83,144 +132,258 @@ class Job:
                 [files.file_path(i), files.file_size(i)])
         return output
 
-    def reap_torrent_file(self):
-        step1 = self.handle.status()
-        step2 = step1.torrent_file
-        step3 = libtorrent.create_torrent(step2)
-        step4 = step3.generate()
-        step5 = libtorrent.bencode(step4)
-        return step5
-
-    def go_to_sleep(self):
-        logger.debug('Job going to sleep')
-        self.handle.pause()
-
-    def wake_up(self):
-        logger.debug('Job waking up')
-        self.handle.resume()
-        status = self.handle.status()
-        self.session_runtime = status.active_time
+    def reap_metadata(self) -> bytes:
+        """ Raw info dict as the session got it, hashes to the infohash """
+        return self.handle.torrent_file().metadata()
+
+    def peers(self, extra=()) -> bytes:
+        """ Up to PARKED_PEERS IPv4 peers, connected ones first, then extra,
+            6 bytes each
+        """
+        endpoints = [peer.ip for peer in self.handle.get_peer_info()]
+        seen = set(endpoints)
+        endpoints += [endpoint for endpoint in extra if endpoint not in seen]
+        return peer_cache.pack_peers(endpoints)[:PARKED_PEERS * 6]
+
+
+class ParkedJob:
+    """ Timed out job waiting for another try, without a handle.
+        Only what is needed to add it again: 20 byte hash, runtimes,
+        attempts and peers it had, packed like in compact tracker replies.
+    """
+    __slots__ = ('id', 'info_hash', 'total_runtime', 'active_time', 'attempts', 'epoch',
+                 'cached_peers', 'peers')
+
+    def __init__(self, job: Job, extra_peers=()) -> None:
+        self.id = job.id
+        self.info_hash = binascii.a2b_hex(job.hexhash)
+        self.total_runtime = job.total_runtime
+        self.active_time = job.active_time
+        self.attempts = job.attempts
+        # deadlines of the next run must not match stale ones of earlier runs
+        self.epoch = job.epoch
+        self.cached_peers = job.cached_peers
+        self.peers = job.peers(extra_peers)
+
+    def to_job(self) -> Job:
+        job = Job()
+        job.id = self.id
+        job.hexhash = binascii.b2a_hex(self.info_hash).decode()
+        job.total_runtime = self.total_runtime
+        job.active_time = self.active_time
+        job.attempts = self.attempts
+        job.epoch = self.epoch
+        job.cached_peers = self.cached_peers
+        return job
+
+    def peer_list(self) -> list:
+        return peer_cache.unpack_peers(self.peers)
+
+def normalize_url(url: str) -> str:
+    """ Scheme and host are case insensitive, path is not """
+    parts = urllib.parse.urlsplit(url.strip())
+    return urllib.parse.urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, parts.fragment))
+
 
 class Trackers:
-    def __init__(self) -> None:
-        self.list = []
+    """ Registry of trackers, stats are stored column-wise,
+        position in urls/uses/resolves is the tracker index
+    """
+    def __init__(self, strategy=None, log_file='') -> None:
+        self.clear()
+        if strategy is None:
+            strategy = tracker_selection.UniformSelection()
+        self.strategy = strategy
+        # announce outcomes as json lines, input for tracker_replay.py
+        self.log_file = log_file
+
+    def clear(self) -> None:
+        self.urls = []
+        self.index = {}  # normalized url -> tracker index
+        self.uses = array.array('q')
+        self.resolves = array.array('q')
+        # values last loaded from or saved to db, saves write the difference
+        self.saved_uses = array.array('q')
+        self.saved_resolves = array.array('q')
+        self.total_uses = 0
         self.num = 0
 
+    def add(self, url:str, uses=0, resolves=0) -> None:
+        url = normalize_url(url)
+        if not url:
+            return
+        idx = self.index.get(url)
+        if idx is None:
+            self.index[url] = len(self.urls)
+            self.urls.append(url)
+            self.uses.append(uses)
+            self.resolves.append(resolves)
+            self.saved_uses.append(0)
+            self.saved_resolves.append(0)
+        else:
+            self.uses[idx] += uses
+            self.resolves[idx] += resolves
+        self.total_uses += uses
+        self.num = len(self.urls)
+
+    def ratio(self, idx:int) -> float:
+        if not self.uses[idx]:
+            return 0
+        return self.resolves[idx] / self.uses[idx]
+
     def load_from_file(self, filename:str) -> None:
         f_h = open(filename, "r", encoding='utf-8')
         trackers = f_h.readlines()
         f_h.close()
         for row in trackers:
-            self.list.append({'url':row.strip('\n'), 'uses':0, 'resolves':0, 'ratio':0})
-        self.num = len(self.list)
+            self.add(row)
 
     def load_from_db(self, cursor, protocols):
         if 'udp' and 'tcp' in protocols:
-            query = 'select url, uses, resolves, ratio from trackers '
+            query = 'select url, uses, resolves from trackers '
         elif 'udp' in protocols:
-            query = 'select url, uses, resolves, ratio from trackers where url like "udp%" '
+            query = 'select url, uses, resolves from trackers where url like "udp%" '
         elif 'tcp' in protocols:
-            query = 'select url, uses, resolves, ratio from trackers where url like "htt%" '
+            query = 'select url, uses, resolves from trackers where url like "htt%" '
         else:
             logger.critical('No protocols (udp/tcp) defined')
             sys.exit()
 
         cursor.execute(query)
         rows = cursor.fetchall()
+        # db is the master copy, reload replaces what is in memory
+        self.clear()
         for row in rows:
-            self.list.append({'url':row[0], 'uses':row[1], 'resolves':row[2], 'ratio':row[3]})
-        self.num = len(self.list)
-
-    def save_to_db(self, cursor):
-        query_check = 'select count(1) from trackers '\
-                        'where url like (%s) '
+            self.add(row[0], row[1], row[2])
+        self.saved_uses = array.array('q', self.uses)
+        self.saved_resolves = array.array('q', self.resolves)
 
-        query_update = 'update trackers set uses = (%s), resolves = (%s), ratio = (%s) '\
-                        'where url like (%s) '
+    @staticmethod
+    def has_url_key(cursor) -> bool:
+        cursor.execute("show index from trackers where Column_name = 'url' and Non_unique = 0")
+        return bool(cursor.fetchall())
 
-        query_insert = 'insert into trackers (uses, resolves, ratio, url) '\
-                        'values (%s, %s, %s, %s) '
-
-        for tracker in self.list:
-            cursor.execute(query_check, (tracker['url'],))
-            row = cursor.fetchone()
-            if row[0] > 0:
-                cursor.execute(query_update, \
-                    (tracker['uses'], tracker['resolves'], tracker['ratio'], tracker['url']))
-            else:
-                print(tracker)
-                cursor.execute(query_insert, \
-                    (tracker['uses'], tracker['resolves'], tracker['ratio'], tracker['url']))
+    def save_to_db(self, cursor):
+        """ One bulk upsert, needs unique key on url, checked by has_url_key,
+            created by migrate_infohash.py trackers
+            Counts added since last load/save are added to db values,
+            so several resolver processes can share the table
+        """
+        query = 'insert into trackers (uses, resolves, ratio, url) '\
+                'values (%s, %s, %s, %s) '\
+                'on duplicate key update '\
+                'uses = uses + values(uses), resolves = resolves + values(resolves), '\
+                'ratio = resolves / greatest(uses, 1) '
+
+        rows = []
+        for idx, url in enumerate(self.urls):
+            uses = self.uses[idx] - self.saved_uses[idx]
+            resolves = self.resolves[idx] - self.saved_resolves[idx]
+            rows.append((uses, resolves, resolves / max(uses, 1), url))
+        if rows:
+            cursor.executemany(query, rows)
+        self.saved_uses = array.array('q', self.uses)
+        self.saved_resolves = array.array('q', self.resolves)
 
     def get_random_url(self, amount:int) -> list:
-        if amount < self.num:
-            trackers = random.sample(self.list, amount)
-        else:
-            trackers = self.list
+        chosen = self.strategy.select(self.uses, self.resolves, self.total_uses, amount)
 
         url_list = []
-        for tracker in trackers:
-#            tracker['uses'] +=1
-            url_list.append(tracker['url'])
+        for idx in chosen:
+            url_list.append(self.urls[idx])
 
         return url_list
 
-    def report_success(self, job:Job) ->None:
-        trackers = job.handle.trackers()
+    def log_outcome(self, urls:list, resolved:bool) -> None:
+        if not self.log_file:
+            return
+        with open(self.log_file, 'a', encoding='utf-8') as f_h:
+            f_h.write(json.dumps({'trackers': urls, 'resolved': resolved}) + '\n')
+
+    def report(self, job:Job, resolved:bool) -> None:
         urls = []
-        for tracker in trackers:
+        for tracker in job.handle.trackers():
             urls.append(tracker['url'])
-        for tracker in self.list:
-            if tracker['url'] in urls:
-                tracker['resolves'] += 1
-                tracker['uses'] +=1
-                tracker['ratio'] = tracker['resolves'] / tracker['uses']
+        self.log_outcome(urls, resolved)
+        for url in urls:
+            idx = self.index.get(normalize_url(url))
+            if idx is None:
+                continue
+            self.uses[idx] += 1
+            self.total_uses += 1
+            if resolved:
+                self.resolves[idx] += 1
+            TRACKER_OUTCOMES.inc(url=self.urls[idx], outcome='resolved' if resolved else 'failed')
+
+    def report_success(self, job:Job) ->None:
+        self.report(job, True)
 
     def report_failure(self, job:Job) ->None:
-        trackers = job.handle.trackers()
-        urls = []
-        for tracker in trackers:
-            urls.append(tracker['url'])
-        for tracker in self.list:
-            if tracker['url'] in urls:
-                tracker['uses'] +=1
-                tracker['ratio'] = tracker['resolves'] / tracker['uses']
+        self.report(job, False)
+
+
+def connect_db():
+    mysql_database_name = "tpb"
+    mysql_user = os.environ.get("mysql_user")
+    mysql_password = os.environ.get("mysql_password")
+    try:
+        conn = mysql.connector.connect(
+            host='localhost',
+            user=mysql_user,
+            password=mysql_password,
+            database=mysql_database_name
+        )
+    except mysql.connector.Error:
+        print('Connection to db failed')
+        sys.exit()
+    return conn
 
 
 class Resolver:
-    def __init__(self) -> None:
+    def __init__(self, writer: db_sink.DbWriter, prefetcher: prefetch.Prefetcher,
+                 committed: queue.Queue, stats_queue=None, worker=0,
+                 a_journal=None) -> None:
         logger.debug('object initialization')
 
         self.last_job_spawn = 0
-        self.jobs: List[Job]
-        self.timeout_jobs: List[Job]
-        self.jobs = []
-        self.timeout_jobs = []
+        self.last_status_update = 0
+        self.jobs: Dict[str, Job]
+        self.jobs = {}  # running jobs by lowercase hexhash
+        self.deadlines = []  # heap of (deadline, epoch, hexhash)
         self.trackers: List[str]
         self.trackers = []
-        self.hashes_to_resolve = []
+        # rows [id, hexhash, runtime, session_runtime] and ParkedJobs
+        self.scheduler = scheduler.Scheduler(args.weights)
         self.count = Counter()
         logger.debug('connecting to db')
-        mysql_database_name = "tpb"
-        mysql_user = os.environ.get("mysql_user")
-        mysql_password = os.environ.get("mysql_password")
-        self.trackers = Trackers()
-        try:
-            self.conn = mysql.connector.connect(
-                host='localhost',
-                user=mysql_user,
-                password=mysql_password,
-                database=mysql_database_name
-            )
-            self.cursor = self.conn.cursor()
-        except mysql.connector.Error:
-            print('Connection to db failed')
-            sys.exit()
+        self.trackers = Trackers(
+            tracker_selection.make_strategy(args.tracker_pick, args.explore),
+            args.tracker_log)
+        self.conn = connect_db()
+        self.cursor = self.conn.cursor()
+        # results are persisted by the writer thread on its own connection
+        self.writer = writer
+        self.committed = committed
+        # new rows are selected by the prefetcher thread
+        self.prefetcher = prefetcher
+        self.prefetch_pending = False
+        self.prefetch_limits = {'new': 0, 'old': 0}    # of the pending request
+        self.prefetch_idle_until = 0
+        self.in_flight = set()  # lowercase hexhashes queued, running or not yet committed
+        # committed while a prefetch was pending, its batch may predate the commit
+        self.committed_in_prefetch = []
+        # job events for runtime recovery after a crash, journal.Journal
+        self.journal = a_journal
+        # set in supervisor mode, counters are reported there
+        self.stats_queue = stats_queue
+        self.worker = worker
+        self.last_metrics_dump = 0
 
         logger.debug('initializing libtorrent session')
         self.protocols = ['udp', 'tcp']
         self.session_settings = libtorrent.default_settings()
-        self.session_settings['listen_interfaces'] = '0.0.0.0:6818'
+        self.session_settings['listen_interfaces'] = '0.0.0.0:{}'.format(args.port)
         self.session_settings['peer_fingerprint'] = 'non-default-finger-print'
         self.session_settings['announce_to_all_trackers']=True #False
         self.session_settings['validate_https_trackers'] = False #true
@@ -239,11 +402,28 @@ class Resolver:
         self.session_settings['enable_incoming_utp'] = 'udp' in self.protocols
         self.session_settings['enable_outgoing_tcp'] = 'tcp' in self.protocols
         self.session_settings['enable_incoming_tcp'] = 'tcp' in self.protocols
-
-        
-        self.lt_session = libtorrent.session()
+        self.session_settings['alert_mask'] = \
+            libtorrent.alert.category_t.status_notification | \
+            libtorrent.alert.category_t.error_notification
+        # peers of aged hashes are kept for their next try
+        self.peer_cache = None
+        if args.peer_cache:
+            self.peer_cache = peer_cache.PeerCache(args.peer_cache, args.peer_age)
+            self.session_settings['alert_mask'] |= \
+                libtorrent.alert.category_t.connect_notification | \
+                libtorrent.alert.category_t.dht_operation_notification
+
+        self.lt_session = self.create_session()
         self.lt_session.apply_settings(self.session_settings)
-        self.sessions_throttle = 0
+        self.controller = concurrency.Controller(
+            limit=args.threads, min_limit=args.min_threads, max_limit=args.max_threads,
+            spawn=args.spawn, interval=args.control_interval, cpu_target=args.cpu_target,
+            max_connections=int(self.session_settings['connections_limit'] * 0.9),
+            log_file=args.control_log)
+        self.last_state_save = time.time()
+        # tracker stats go to db periodically once loaded from there
+        self.trackers_loaded = False
+        self.last_trackers_save = time.time()
   
         self.lt_params = libtorrent.add_torrent_params()
         ltflags = libtorrent.add_torrent_params_flags_t
@@ -259,131 +439,213 @@ class Resolver:
         self.lt_params.storage_mode = libtorrent.storage_mode_t(2)
         self.lt_params.max_connections = 3
 
+    def create_session(self):
+        """ Session restored from args.state_file keeps the DHT routing table,
+            so restarts skip the cold DHT bootstrap
+        """
+        buf = b''
+        if args.state_file and os.path.exists(args.state_file):
+            with open(args.state_file, 'rb') as f_h:
+                buf = f_h.read()
+        if not buf:
+            return libtorrent.session()
+
+        logger.info('restoring session state from %s', args.state_file)
+        try:
+            if hasattr(libtorrent, 'read_session_params'):     # libtorrent 2.x
+                return libtorrent.session(libtorrent.read_session_params(buf))
+            lt_session = libtorrent.session()
+            lt_session.load_state(libtorrent.bdecode(buf))
+            return lt_session
+        except RuntimeError:
+            logger.warning('unusable session state in %s, starting cold', args.state_file)
+            return libtorrent.session()
+
+    def save_state(self):
+        # the known hashes filter is saved by the prefetcher thread
+        self.last_state_save = time.time()
+        if self.peer_cache is not None:
+            self.peer_cache.evict()
+        if not args.state_file:
+            return
+        if hasattr(libtorrent, 'write_session_params_buf'):     # libtorrent 2.x
+            buf = libtorrent.write_session_params_buf(self.lt_session.session_state())
+        else:
+            buf = libtorrent.bencode(self.lt_session.save_state())
+        tmp_name = args.state_file + '.tmp'
+        with open(tmp_name, 'wb') as f_h:
+            f_h.write(buf)
+        os.replace(tmp_name, args.state_file)
+        logger.debug('session state saved')
+
     def get_trackers(self):
         #self.trackers.load_from_file('trackerlist.txt')
         #self.save_trackers()
         self.trackers.load_from_db(self.cursor, self.protocols)
+        self.trackers_loaded = True
 
     def save_trackers(self):
         self.trackers.save_to_db(self.cursor)
         self.conn.commit()
+        self.last_trackers_save = time.time()
 
-    def get_new_jobs(self) -> int:  # number of new jobs
-        logger.debug('loading new jobs')
-        query = 'select id, infohash from hashes_to_resolve '\
-                'order by id '\
-                'limit %s'
-
-        self.cursor.execute(query, (args.maxnew,))
-        rows = self.cursor.fetchall()
-        for row in rows:
-            self.hashes_to_resolve.append([row[0], row[1], 0, 0])
-        self.count.increase('new', len(rows))
-        return
-
-    def get_old_jobs(self) -> int:
-        logger.debug('Loading old jobs')
-        query = 'select id, infohash, runtime from old_hashes_to_resolve '\
-                'order by runtime asc '\
-                'limit %s'
-        self.cursor.execute(query, (args.maxold,))
-        rows = self.cursor.fetchall()
-        for row in rows:
-            self.hashes_to_resolve.append([row[0], row[1], row[2], 0])
-        self.count.increase('old', len(rows))
-        return
-
-    def sort_jobs(self):
-        pass
-        # sorting actually done in select preparing hashes in db
-        #logger.warning("Sorting not implemented yet")
+    def refill(self):
+        """ Keeps the scheduler between low and high watermark,
+            rows are selected by the prefetcher while jobs keep running
+        """
+        while True:
+            try:
+                batch = self.prefetcher.batches.get_nowait()
+            except queue.Empty:
+                break
+            self.prefetch_pending = False
+            fresh = {'new': 0, 'old': 0}
+            for source, row in batch:
+                hexhash = row[1].lower()
+                # old rows are over-selected by what is in flight
+                if hexhash in self.in_flight or fresh[source] >= self.prefetch_limits[source]:
+                    continue
+                self.in_flight.add(hexhash)
+                self.scheduler.push(source, row, runtime=row[2])
+                fresh[source] += 1
+            self.count.increase('new', fresh['new'])
+            self.count.increase('old', fresh['old'])
+            if not fresh['new'] + fresh['old']:
+                # tables drained, don't hammer db
+                self.prefetch_idle_until = time.time() + args.idle
+            # the batch was filtered, later selects see the commits
+            for hexhash in self.committed_in_prefetch:
+                self.in_flight.discard(hexhash)
+            self.committed_in_prefetch = []
+        # its batch would never come, the loop would wait for it forever
+        if self.prefetch_pending and not self.prefetcher.is_alive():
+            raise RuntimeError('prefetcher died')
+
+        # hashes leave in_flight only once their queue rows are committed,
+        # otherwise a prefetch could select them again
+        while True:
+            try:
+                hexhashes = self.committed.get_nowait()
+            except queue.Empty:
+                break
+            for hexhash in hexhashes:
+                if self.prefetch_pending:
+                    self.committed_in_prefetch.append(hexhash.lower())
+                else:
+                    self.in_flight.discard(hexhash.lower())
+            if self.journal is not None:
+                self.journal.settle(hexhashes)
+
+        waiting = self.scheduler.waiting()
+        if self.prefetch_pending or waiting >= args.low_watermark or \
+                time.time() < self.prefetch_idle_until:
+            return
+        amount = args.high_watermark - waiting
+        new_limit = min(args.maxnew, amount * args.maxnew // (args.maxnew + args.maxold))
+        old_limit = min(args.maxold, amount - new_limit)
+        self.prefetcher.request(new_limit, old_limit, len(self.in_flight))
+        self.prefetch_limits = {'new': new_limit, 'old': old_limit}
+        self.prefetch_pending = True
+
+    def spawn_next(self):
+        source, item = self.scheduler.pop()
+        SPAWNS.inc(source=source)
+        if source == 'timeout':
+            self.wake_a_job(item)
+        else:
+            self.spawn_a_job(item)
 
-    def spawn_a_job(self):
-        logger.debug('spawning a job')
-        job = Job()
-        job.id, job.hexhash, job.total_runtime, job.session_runtime = \
-            self.hashes_to_resolve.pop(0)
+    def add_handle(self, job: Job, peers=()):
         self.lt_params.info_hash = libtorrent.sha1_hash(
             binascii.a2b_hex(job.hexhash))
         self.lt_params.name = "name_" + job.hexhash
         self.lt_params.trackers = self.trackers.get_random_url(3)
+        self.lt_params.peers = list(peers)
         job.handle = self.lt_session.add_torrent(self.lt_params)
 
         job.handle.resume()
-        self.jobs.append(job)
-        _cur_trackers = job.handle.trackers()
+        job.start_clock()
+        self.jobs[job.hexhash.lower()] = job
+        self.schedule_deadline(job)
         self.last_job_spawn = time.time()
 
+    def spawn_a_job(self, row):
+        logger.debug('spawning a job')
+        job = Job()
+        job.id, job.hexhash, job.total_runtime, job.session_runtime = row
+        peers = []
+        if self.peer_cache is not None and job.total_runtime:
+            peers = self.peer_cache.get(job.hexhash)
+            job.cached_peers = len(peers)
+        self.add_handle(job, peers)
+        self.journal_event('spawn', job)
+
         logger.debug('hashes %s, running %s, sleeping %s',
-                     len(self.hashes_to_resolve), len(self.jobs), len(self.timeout_jobs))
+                     self.scheduler.waiting(), len(self.jobs), self.scheduler.sleeping())
 
     def can_spawn_job(self) -> bool:
         tmp_bool = True
-        if self.sessions_throttle:
-            tmp_bool = tmp_bool and time.time() > \
-            self.last_job_spawn + args.spawn * (1 + len(self.jobs)/self.sessions_throttle)
-        else:
-            tmp_bool = tmp_bool and time.time() > self.last_job_spawn + args.spawn
-        tmp_bool = tmp_bool and (self.hashes_to_resolve or self.timeout_jobs)
-        tmp_bool = tmp_bool and len(self.jobs) < args.threads
+        # limit and spawn interval are tuned by the controller
+        tmp_bool = tmp_bool and time.time() > self.last_job_spawn + self.controller.spawn
+        tmp_bool = tmp_bool and len(self.scheduler) > 0
+        tmp_bool = tmp_bool and len(self.jobs) < self.controller.limit
+        # backpressure, don't produce results faster than db takes them
+        tmp_bool = tmp_bool and not self.writer.is_behind()
         return tmp_bool
 
-    def end_a_job(self, job):
+    def end_a_job(self, job, a_torrent):
         logger.debug('Removing a job completely')
         job.just_die(self.lt_session)
-
-        if job.total_runtime == 0:  # a new hash
-            query = 'delete from hashes_to_resolve '\
-                    'where id = (%s) and infohash like (%s) '
-        else:
-            query = 'delete from old_hashes_to_resolve '\
-                    'where id = (%s) and infohash like (%s) '
-
-        self.cursor.execute(query, (job.id, job.hexhash))
-        self.conn.commit()
-        self.jobs.remove(job)
+        # torrents/files update, .torrent save and queue delete are done by the writer
+        self.writer.put(('resolved', job.id, job.hexhash, job.total_runtime == 0, a_torrent))
+        self.journal_event('resolve', job)
+        del self.jobs[job.hexhash.lower()]
 
     def enqueue_a_job(self, job: Job):
-        logger.debug('timed out job -> back to queueto the end of queue')
-        job.go_to_sleep()
-        self.jobs.remove(job)
-        self.timeout_jobs.append(job)
-
-    def wake_a_job(self):
+        """ Timed out job is parked, its handle is removed from the session
+            and added again on wake up, with the peers it had
+        """
+        logger.debug('timed out job -> parked at the end of queue')
+        job.stop_clock()
+        job.attempts += 1
+        # peers noted while it ran go with it instead of staying in the cache
+        noted = self.peer_cache.take(job.hexhash) if self.peer_cache is not None else ()
+        parked = ParkedJob(job, noted)
+        self.lt_session.remove_torrent(job.handle)
+        self.journal_event('sleep', job)
+        del self.jobs[job.hexhash.lower()]
+        self.scheduler.push('timeout', parked, runtime=job.total_runtime + job.active_time,
+                            attempts=job.attempts)
+
+    def wake_a_job(self, parked: ParkedJob):
         logger.debug('Waking up a timed out(previously) job')
-        job = self.timeout_jobs.pop(0)
-        job.wake_up()
-        self.jobs.append(job)
+        job = parked.to_job()
+        self.add_handle(job, parked.peer_list())
+        self.journal_event('wake', job)
         logger.debug('hashes %s, running %s, sleeping %s',
-                     len(self.hashes_to_resolve), len(self.jobs), len(self.timeout_jobs))
-        self.last_job_spawn = time.time()
+                     self.scheduler.waiting(), len(self.jobs), self.scheduler.sleeping())
 
     def offload_aged_job(self, job: Job):
         logger.debug('offloading aged job to db')
+        if self.peer_cache is not None:
+            self.peer_cache.store(job.hexhash, peer_cache.unpack_peers(job.peers()))
         job.just_die(self.lt_session)
+        self.journal_event('offload', job)
         if job.total_runtime == 0:  # It was a new hash
-            query = 'delete from hashes_to_resolve '\
-                    'where id = (%s) and infohash like (%s) '
-            self.cursor.execute(query, (job.id, job.hexhash))
-
-            query = 'insert into old_hashes_to_resolve '\
-                    '(id, infohash, runtime) '\
-                    'values (%s, %s, %s)'
-            self.cursor.execute(
-                query, (job.id, job.hexhash, job.session_runtime))
-
+            self.writer.put(('offloaded', job.id, job.hexhash, True, job.session_runtime))
         else:  # it was an old hash
             job.total_runtime += job.session_runtime
-            query = 'update old_hashes_to_resolve '\
-                    'set runtime = (%s) '\
-                    'where id = (%s) and infohash like (%s) '
-            self.cursor.execute(
-                query, (job.total_runtime, job.id, job.hexhash))
+            self.writer.put(('offloaded', job.id, job.hexhash, False, job.total_runtime))
 
-        self.conn.commit()
-        self.jobs.remove(job)
+        del self.jobs[job.hexhash.lower()]
         self.count.increase('offloaded', 1)
 
+    def journal_event(self, event: str, job: Job):
+        if self.journal is None:
+            return
+        self.journal.record(event, job.hexhash, job.id, job.total_runtime == 0,
+                            job.total_runtime + job.active_time)
+
     def push_resolved_hash_to_db(self, output):
         assert False
         query = 'insert into resolved_hashes '\
@@ -407,96 +669,202 @@ class Resolver:
         self.conn.commit()
         self.count.increase('resolved', 1)
 
+    def report_stats(self):
+        values = dict(self.count.values)
+        values['queue'] = self.scheduler.waiting()
+        values['active'] = len(self.jobs)
+        values['sleep'] = self.scheduler.sleeping()
+        self.stats_queue.put((self.worker, values))
+
+    def update_metrics(self):
+        QUEUES.set(self.scheduler.count('new'), queue='new')
+        QUEUES.set(self.scheduler.count('old'), queue='old')
+        QUEUES.set(self.scheduler.sleeping(), queue='sleeping')
+        QUEUES.set(len(self.jobs), queue='running')
+        QUEUES.set(len(self.in_flight), queue='in_flight')
+        QUEUES.set(self.writer.queue.qsize(), queue='writer')
+        if args.metrics_file and time.time() > self.last_metrics_dump + args.metrics_interval:
+            metrics.registry.dump(args.metrics_file, {'worker': self.worker})
+            self.last_metrics_dump = time.time()
+
     def print_stats_inline(self):
         print('new {} old, {}, resolved {}, queue {}, active {}, sleep {}, offloaded {}    \r'\
             .format(self.count.value_of('new'), self.count.value_of('old'), \
-                    self.count.value_of('resolved'), len(self.hashes_to_resolve), \
-                    len(self.jobs), len(self.timeout_jobs), self.count.value_of('offloaded')\
+                    self.count.value_of('resolved'), self.scheduler.waiting(), \
+                    len(self.jobs), self.scheduler.sleeping(), self.count.value_of('offloaded')\
             ), end='')
 
+    def connections(self) -> int:
+        """ Peers of all running jobs, as of the last state update """
+        peers = 0
+        for job in self.jobs.values():
+            if job.status is not None:
+                peers += job.status.num_peers
+        return peers
+
+    def schedule_deadline(self, job: Job):
+        heapq.heappush(self.deadlines,
+                       (job.next_deadline(), job.epoch, job.hexhash.lower()))
+
+    def reap_a_job(self, job: Job):
+        #output = job.reap_data()
+        # self.push_resolved_hash_to_db(output)
+
+        a_torrent = my_torrent_stuff.Torrent()
+        a_torrent.digest_metadata(job.reap_metadata())
+        assert a_torrent.fl_hexhash.lower() == job.hexhash.lower()
+        TIME_TO_METADATA.observe(job.active_time + time.monotonic() - job.run_since,
+                                 kind='new' if job.total_runtime == 0 else 'old',
+                                 cached_peers='yes' if job.cached_peers else 'no')
+        if self.peer_cache is not None:
+            self.peer_cache.forget(job.hexhash, cached=job.total_runtime > 0)
+        JOBS_ENDED.inc(outcome='resolved')
+        self.trackers.report_success(job)
+        self.end_a_job(job, a_torrent)
+        self.prefetcher.add_known(job.hexhash)
+        self.count.increase('resolved', 1)
+        logger.debug('Saved resolved job')
+
+    def handle_alert(self, alert):
+        if isinstance(alert, libtorrent.metadata_received_alert):
+            job = self.jobs.get(str(alert.handle.info_hash()))
+            if job is not None:
+                job.status = alert.handle.status()
+                self.reap_a_job(job)
+
+        elif isinstance(alert, libtorrent.peer_connect_alert):
+            hexhash = str(alert.handle.info_hash())
+            if self.peer_cache is not None and hexhash in self.jobs:
+                self.peer_cache.note(hexhash, alert.endpoint)
+
+        elif isinstance(alert, libtorrent.dht_get_peers_reply_alert):
+            hexhash = str(alert.info_hash)
+            if self.peer_cache is not None and hexhash in self.jobs:
+                for endpoint in alert.peers():
+                    self.peer_cache.note(hexhash, endpoint)
+
+        elif isinstance(alert, libtorrent.state_update_alert):
+            for status in alert.status:
+                job = self.jobs.get(str(status.info_hash))
+                if job is None:
+                    continue
+                job.status = status
+                # metadata_received_alert may have been dropped on alert queue overflow
+                if job.is_complete():
+                    self.reap_a_job(job)
+
+    def check_deadlines(self):
+        """ Pops only jobs whose timeout or age limit has passed,
+            entries of jobs which died or were put to sleep meanwhile are stale
+        """
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, epoch, hexhash = heapq.heappop(self.deadlines)
+            job = self.jobs.get(hexhash)
+            if job is None or job.epoch != epoch:
+                continue
+
+            # a live entry means timeout or age limit was hit
+            if job.is_aged(now):
+                JOBS_ENDED.inc(outcome='offloaded')
+                self.trackers.report_failure(job)
+                self.offload_aged_job(job)
+            else:
+                JOBS_ENDED.inc(outcome='timeout')
+                self.enqueue_a_job(job)
+
     def run_loop(self):
         """ Main part of program, once initialized runs indefinitely
             or until jobs are done (unlikely)
+            Work is driven by libtorrent alerts, cost grows with events
+            not with the number of running jobs
         """
 
-        while self.jobs or self.hashes_to_resolve or self.timeout_jobs:
-            if self.can_spawn_job():
-                if self.hashes_to_resolve:
-                    self.spawn_a_job()
-                else:
-                    self.wake_a_job()
-
-            count = 0
-            for job in reversed(self.jobs):
-                if self.can_spawn_job():
-                    if self.hashes_to_resolve:
-                        self.spawn_a_job()
-                    else:
-                        self.wake_a_job()
-
-                time.sleep(args.heartbeat)
-
-                count +=1
-                if job.is_complete():
-                    #output = job.reap_data()
-                    # self.push_resolved_hash_to_db(output)
-
-                    a_torrent = my_torrent_stuff.Torrent()
-                    a_torrent.torfile = job.reap_torrent_file()
-                    a_torrent.digest_torfile()
-                    assert a_torrent.fl_hexhash.lower() == job.hexhash.lower()
-                    a_torrent.get_db_info(self.cursor, dbtype='mysql')
-                    a_torrent.update_db(self.cursor, dbtype='mysql')
-
-                    if args.torrents_dir:
-                        a_torrent.save_file_to(args.torrents_dir)
-                    self.trackers.report_success(job)
-                    self.end_a_job(job)
-                    self.count.increase('resolved', 1)
-                    logger.debug('Saved resolved job')
-
-                elif job.is_aged():
-                    self.trackers.report_failure(job)
-                    self.offload_aged_job(job)
-
-                elif job.is_timeout():
-                    self.enqueue_a_job(job)
-
-                self.print_stats_inline()
-
-
-            logger.info('new %s, old %s, resolved %s, offloaded %s',
-                        self.count.value_of('new'), self.count.value_of('old'),
-                        self.count.value_of('resolved'), self.count.value_of('offloaded'))
-            logger.info('trackers %s, hashes %s, running %s, sleeping %s',
-                        self.trackers.num, 
-                        len(self.hashes_to_resolve), len(self.jobs), len(self.timeout_jobs))
-            self.print_stats_inline()
-
+        self.refill()
+        while self.jobs or self.scheduler or self.prefetch_pending:
+            while self.can_spawn_job():
+                self.spawn_next()
+
+            if time.time() > self.last_status_update + STATUS_UPDATE_INTERVAL:
+                self.lt_session.post_torrent_updates()
+                self.last_status_update = time.time()
+                if self.stats_queue is not None:
+                    self.report_stats()
+                logger.info('new %s, old %s, resolved %s, offloaded %s',
+                            self.count.value_of('new'), self.count.value_of('old'),
+                            self.count.value_of('resolved'), self.count.value_of('offloaded'))
+                logger.info('trackers %s, hashes %s, running %s, sleeping %s',
+                            self.trackers.num,
+                            self.scheduler.waiting(), len(self.jobs), self.scheduler.sleeping())
+                flushes, batch_size, flush_latency = self.writer.stats()
+                logger.info('db flushes %s, last batch %s rows in %.1fms, writer queue %s',
+                            flushes, batch_size, flush_latency * 1000,
+                            self.writer.queue.qsize())
+                self.update_metrics()
+                # terminal output only once per status interval
+                if self.stats_queue is None:
+                    self.print_stats_inline()
+
+            self.lt_session.wait_for_alert(int(args.heartbeat * 1000))
+            alerts = self.lt_session.pop_alerts()
+            backlog = 0
+            for alert in alerts:
+                ALERTS.inc(type=type(alert).__name__)
+                self.handle_alert(alert)
+                # peer cache bookkeeping is a dict insert, not backlog
+                if not isinstance(alert, PEER_ALERTS):
+                    backlog += 1
+            self.controller.note(len(self.jobs), backlog)
+            if self.controller.is_due(time.time()):
+                self.controller.update(time.time(), time.process_time(),
+                                       self.count.value_of('resolved'), self.connections(),
+                                       self.writer.is_behind())
+
+            self.check_deadlines()
+            self.refill()
+            if self.journal is not None:
+                self.journal.maybe_commit()
+            if self.peer_cache is not None:
+                self.peer_cache.maybe_commit()
+            if time.time() > self.last_state_save + args.state_interval:
+                self.save_state()
+            if self.trackers_loaded and \
+                    time.time() > self.last_trackers_save + args.state_interval:
+                # a crash loses one interval of stats, reload takes other nodes' counts
+                self.save_trackers()
+                self.get_trackers()
+
+        # next cycle selects from queue tables, they have to be up to date
+        self.writer.sync()
         logger.info('No more jobs')
 
-def main():
-    resolver = Resolver()
-    while True:
-        resolver.get_trackers()
-        resolver.get_new_jobs()
-        resolver.get_old_jobs()
-        resolver.sort_jobs()
-        resolver.run_loop()
-        logger.info('Cycle complete, trying to get new jobs')
+def run_resolver(resolver: Resolver):
+    # without the key every save would insert a new row per tracker
+    if not resolver.trackers.has_url_key(resolver.cursor):
+        logger.critical('trackers table has no unique key on url, '
+                        'run migrate_infohash.py trackers')
+        sys.exit()
+    try:
+        while True:
+            resolver.get_trackers()
+            resolver.run_loop()
+            logger.info('Queue tables drained, waiting for new hashes')
+            resolver.save_trackers()
+            resolver.save_state()
+            time.sleep(args.idle)
+    finally:
         resolver.save_trackers()
-        old_resolver = resolver
-        old_resolver.lt_session.pause()
-        resolver = Resolver()
-        resolver.count = old_resolver.count
-        time.sleep(3)
-        del old_resolver
+        resolver.save_state()
+        if resolver.journal is not None:
+            resolver.journal.close()
+        if resolver.peer_cache is not None:
+            resolver.peer_cache.close()
 
 
-if __name__ == "__main__":
+def make_logger():
     import logging
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.WARNING)
+    a_logger = logging.getLogger(__name__)
+    a_logger.setLevel(logging.WARNING)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     fh = logging.FileHandler(__name__ + '.txt')
     fh.setLevel(logging.DEBUG)
@@ -505,34 +873,322 @@ if __name__ == "__main__":
     sh.setLevel(logging.INFO)
     sh.setFormatter(formatter)
 
-    #logger.addHandler(fh)
-    logger.addHandler(sh)
+    #a_logger.addHandler(fh)
+    a_logger.addHandler(sh)
+    return a_logger
+
+
+def make_store():
+    if not args.torrents_dir:
+        return None
+    return torrent_store.TorrentStore(args.torrents_dir, pack=args.pack)
+
+
+def make_journal(dbtype='mysql'):
+    """ Journal of args.journal, runtimes of jobs lost by the last run
+        are put back into the queue tables first
+    """
+    if not args.journal:
+        return None
+    a_journal = journal.Journal(args.journal, commit_interval=args.journal_interval)
+    pending = a_journal.replay()
+    if pending:
+        conn = connect_db()
+        a_journal.reconcile(conn, pending, dbtype=dbtype)
+        conn.close()
+    a_journal.open()
+    return a_journal
+
+
+def make_prefetcher(shard=None) -> prefetch.Prefetcher:
+    lease_table = None
+    if args.lease:
+        lease_table = leases.Leases(args.node, args.lease, dbtype='mysql')
+    return prefetch.Prefetcher(connect_db, dbtype='mysql', shard=shard, leases=lease_table,
+                               known_file=args.known_file, known_interval=args.state_interval)
+
+
+def worker_main(worker_args, worker, writer_queue, committed, stats_queue):
+    """ Entry of a resolver process in supervisor mode, owns one shard """
+    global args, logger
+    args = worker_args
+    if 'logger' not in globals():   # spawn start method, __main__ block did not run
+        logger = make_logger()
+    args.port += worker
+    if args.state_file:
+        args.state_file = '{}.{}'.format(args.state_file, worker)
+    args.node = '{}.{}'.format(args.node, worker)
+    if args.metrics_port:
+        args.metrics_port += worker
+    if args.metrics_file:
+        args.metrics_file = '{}.{}'.format(args.metrics_file, worker)
+    if args.control_log:
+        args.control_log = '{}.{}'.format(args.control_log, worker)
+    if args.known_file:
+        args.known_file = '{}.{}'.format(args.known_file, worker)
+    if args.journal:
+        args.journal = '{}.{}'.format(args.journal, worker)
+    if args.peer_cache:
+        args.peer_cache = '{}.{}'.format(args.peer_cache, worker)
+
+    if args.metrics_port:
+        metrics.registry.serve(args.metrics_port)
+    writer = db_sink.RemoteWriter(writer_queue, args.writer_queue)
+    a_journal = make_journal()
+    prefetcher = make_prefetcher(shard=(worker, args.workers))
+    prefetcher.start()
+    resolver = Resolver(writer, prefetcher, committed, stats_queue, worker, a_journal)
+    try:
+        run_resolver(resolver)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # results may still wait in the supervisor's writer,
+        # it releases the leases once they are written
+        prefetcher.stop(release=False)
+
+
+class ShardRouter:
+    """ Sends committed hexhashes back to the worker owning their shard """
+
+    def __init__(self, queues: list):
+        self.queues = queues
+
+    def put(self, hexhashes: list):
+        per_worker = []
+        for _ in self.queues:
+            per_worker.append([])
+        for hexhash in hexhashes:
+            per_worker[prefetch.shard_of(hexhash, len(self.queues))].append(hexhash)
+        for idx, a_queue in enumerate(self.queues):
+            if per_worker[idx]:
+                a_queue.put(per_worker[idx])
+
+
+def release_worker_leases():
+    conn = connect_db()
+    cursor = conn.cursor()
+    for worker in range(args.workers):
+        leases.Leases('{}.{}'.format(args.node, worker), args.lease).release_all(cursor)
+    conn.commit()
+    conn.close()
+
+
+def supervise():
+    """ Runs args.workers resolver processes on consecutive ports,
+        each resolving its own infohash shard, all results go through
+        one db writer in this process
+    """
+    writer_queue = multiprocessing.Queue(maxsize=args.writer_queue)
+    stats_queue = multiprocessing.Queue()
+    committed = []
+    for _ in range(args.workers):
+        committed.append(multiprocessing.Queue())
+    writer = db_sink.DbWriter(connect_db, writer_queue,
+                              max_rows=args.batch_rows, max_delay=args.batch_time,
+                              dbtype='mysql', store=make_store(),
+                              committed=ShardRouter(committed), leases=bool(args.lease))
+
+    workers = []
+    for worker in range(args.workers):
+        process = multiprocessing.Process(
+            target=worker_main, name='resolver {}'.format(worker),
+            args=(args, worker, writer_queue, committed[worker], stats_queue))
+        process.start()
+        workers.append(process)
+    # threads only after forking, children must not inherit their locks
+    writer.start()
+    # writer flush metrics, on the port after the workers' ones
+    if args.metrics_port:
+        metrics.registry.serve(args.metrics_port + args.workers)
+    metrics_file = '{}.supervisor'.format(args.metrics_file) if args.metrics_file else ''
+
+    stats = {}
+    last_print = 0
+    last_metrics_dump = 0
+    try:
+        while any(process.is_alive() for process in workers):
+            if not writer.is_alive():
+                # workers would wait on a full writer queue forever
+                logger.critical('db writer died, stopping workers')
+                for process in workers:
+                    process.terminate()
+                break
+            try:
+                worker, values = stats_queue.get(timeout=STATUS_UPDATE_INTERVAL)
+                stats[worker] = values
+            except queue.Empty:
+                pass
+            if metrics_file and time.time() > last_metrics_dump + args.metrics_interval:
+                metrics.registry.dump(metrics_file, {'worker': 'supervisor'})
+                last_metrics_dump = time.time()
+            if time.time() < last_print + STATUS_UPDATE_INTERVAL:
+                continue
+            last_print = time.time()
+            total = Counter()
+            for name in ['queue', 'active', 'sleep']:
+                total.values[name] = 0
+            for values in stats.values():
+                for name, value in values.items():
+                    total.increase(name, value)
+            flushes, batch_size, flush_latency = writer.stats()
+            print('workers {}, new {} old, {}, resolved {}, queue {}, active {}, sleep {}, '\
+                  'offloaded {}, db flushes {} last {} rows {:.1f}ms    \r'\
+                .format(len(stats), total.value_of('new'), total.value_of('old'),
+                        total.value_of('resolved'), total.value_of('queue'),
+                        total.value_of('active'), total.value_of('sleep'),
+                        total.value_of('offloaded'), flushes, batch_size,
+                        flush_latency * 1000), end='')
+    finally:
+        for process in workers:
+            process.join()
+        # results buffered in the writer must not be lost
+        written = writer.is_alive()
+        writer.stop()
+        if metrics_file:
+            metrics.registry.dump(metrics_file, {'worker': 'supervisor'})
+        # leases go only after results are written, else they run out
+        if args.lease and written:
+            release_worker_leases()
+
 
+def main():
+    if args.workers > 1:
+        supervise()
+        return
+
+    if args.metrics_port:
+        metrics.registry.serve(args.metrics_port)
+
+    committed = queue.Queue()
+    writer = db_sink.DbWriter(connect_db, queue.Queue(maxsize=args.writer_queue),
+                              max_rows=args.batch_rows, max_delay=args.batch_time,
+                              dbtype='mysql', store=make_store(),
+                              committed=committed, leases=bool(args.lease))
+    writer.start()
+    # before anything is selected, lost runtimes go back to the tables
+    a_journal = make_journal()
+    prefetcher = make_prefetcher()
+    prefetcher.start()
+    # one long lived session, queue is refilled in place while jobs run
+    resolver = Resolver(writer, prefetcher, committed, a_journal=a_journal)
+    try:
+        run_resolver(resolver)
+    finally:
+        # results buffered in the writer must not be lost
+        writer.stop()
+        # leases go only after results are written
+        prefetcher.stop()
+
+
+def parse_args(argv=None):
     from argparse import ArgumentParser
     parser = ArgumentParser(
         description='Unknown/incomplete info hash resolver')
 
     parser.add_argument('-d', '-dir', dest='torrents_dir', default='', type=str,
-                        help='directory to save torrent files, default don\'t save')
+                        help='store of torrent files, by infohash, default don\'t save')
+    parser.add_argument('-pack', dest='pack', default=False, action='store_true',
+                        help='append small torrent files to pack files in the store')
     parser.add_argument('-timeout', dest='timeout', default=50, type=int,
                         help='timeout in seconds for single try of hash')
     parser.add_argument('-aged', dest='aged', default=80, type=int,
                         help='timeout in seconds before offload back to db')
+    parser.add_argument('-workers', dest='workers', default=1, type=int,
+                        help='resolver processes, each on its own port and infohash shard')
+    parser.add_argument('-port', dest='port', default=6818, type=int,
+                        help='listen port, workers use consecutive ports')
     parser.add_argument('-threads', dest='threads', default=200, type=int,
-                        help='maximum concurrent hashes')
+                        help='concurrent hashes at start, then tuned between min and max')
+    parser.add_argument('-minthreads', dest='min_threads', default=20, type=int,
+                        help='lower bound of concurrent hashes')
+    parser.add_argument('-maxthreads', dest='max_threads', default=2000, type=int,
+                        help='upper bound of concurrent hashes, equal min and max to disable tuning')
     parser.add_argument('-spawntime', dest='spawn', default=100, type=int,
-                        help='min time between torrent spawns in miliseconds')
+                        help='min time between torrent spawns in miliseconds, '\
+                             'raised by the controller under load')
+    parser.add_argument('-cpu', dest='cpu_target', default=0.9, type=float,
+                        help='cpu use, in cores, above which concurrency is cut')
+    parser.add_argument('-controlinterval', dest='control_interval', default=10, type=int,
+                        help='seconds between concurrency decisions')
+    parser.add_argument('-controllog', dest='control_log', default='', type=str,
+                        help='append concurrency decisions as json lines to this file')
     parser.add_argument('-maxnew', dest='maxnew', default=1000, type=int,
-                        help='maximum new hashes at once')
+                        help='maximum new hashes in one prefetch')
     parser.add_argument('-maxold', dest='maxold', default=100, type=int,
-                        help='maximum old hashes at once')
+                        help='maximum old hashes in one prefetch')
+
+    parser.add_argument('-trackerpick', dest='tracker_pick', default='uniform',
+                        choices=sorted(tracker_selection.STRATEGIES),
+                        help='how trackers for a hash are chosen')
+    parser.add_argument('-explore', dest='explore', default=0.1, type=float,
+                        help='fraction of tracker slots always picked at random')
+    parser.add_argument('-trackerlog', dest='tracker_log', default='', type=str,
+                        help='append announce outcomes to file, for tracker_replay.py')
+
+    parser.add_argument('-low', dest='low_watermark', default=400, type=int,
+                        help='prefetch more hashes when fewer are queued')
+    parser.add_argument('-high', dest='high_watermark', default=1100, type=int,
+                        help='prefetch up to this many queued hashes')
+    parser.add_argument('-idle', dest='idle', default=3, type=int,
+                        help='seconds to wait before selecting again from drained tables')
+
+    parser.add_argument('-lease', dest='lease', default=0, type=int,
+                        help='claim hashes with leases of this many seconds, '\
+                             'for several nodes on one db, 0 disables')
+    parser.add_argument('-node', dest='node', default=socket.gethostname(), type=str,
+                        help='lease owner name, unique per node')
+
+    parser.add_argument('-weights', dest='weights', default='1,1,1', type=str,
+                        help='new,old,timed out jobs spawned per scheduler round')
+
+    parser.add_argument('-state', dest='state_file', default='resolver_session.state', type=str,
+                        help='file keeping session and DHT state between runs, empty to disable')
+    parser.add_argument('-known', dest='known_file', default='resolver_known.bloom', type=str,
+                        help='filter of resolved hashes, they are dropped from the queue '\
+                             'tables unseen, empty to disable')
+    parser.add_argument('-journal', dest='journal', default='resolver.journal', type=str,
+                        help='journal of in-flight jobs, their runtime is recovered '\
+                             'after a crash, empty to disable')
+    parser.add_argument('-journalinterval', dest='journal_interval', default=1.0, type=float,
+                        help='seconds between journal writes, at most this much is lost')
+    parser.add_argument('-peercache', dest='peer_cache', default='resolver_peers.db', type=str,
+                        help='file keeping peers of aged hashes for their next try, '\
+                             'empty to disable')
+    parser.add_argument('-peerage', dest='peer_age', default=6 * 3600, type=int,
+                        help='seconds cached peers are used')
+    parser.add_argument('-stateinterval', dest='state_interval', default=300, type=int,
+                        help='seconds between saves of session state, tracker stats '\
+                             'and the known hashes filter')
+
+    parser.add_argument('-batch', dest='batch_rows', default=50, type=int,
+                        help='db writes buffered before a flush')
+    parser.add_argument('-batchtime', dest='batch_time', default=500, type=int,
+                        help='max time in miliseconds a db write is buffered')
+    parser.add_argument('-writerqueue', dest='writer_queue', default=1000, type=int,
+                        help='db writer queue size, spawning pauses when half full')
 
     parser.add_argument('-hb', '--heartbeat', dest='heartbeat', default=10, type=int,
                         help='sleep time between actions')
 
+    parser.add_argument('-metricsport', dest='metrics_port', default=0, type=int,
+                        help='serve Prometheus metrics on this port, workers use consecutive '
+                             'ports and the supervisor the one after them')
+    parser.add_argument('-metricsfile', dest='metrics_file', default='', type=str,
+                        help='append metrics as json lines to this file')
+    parser.add_argument('-metricsinterval', dest='metrics_interval', default=60, type=int,
+                        help='seconds between metrics file dumps')
+
     parser.add_argument('--version', action='version', version=VERSION)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     args.spawn = args.spawn / 1000
     args.heartbeat = args.heartbeat / 1000
+    args.batch_time = args.batch_time / 1000
+    args.weights = dict(zip(scheduler.SOURCES, [int(x) for x in args.weights.split(',')]))
+    return args
+
 
+if __name__ == "__main__":
+    logger = make_logger()
+    args = parse_args()
     main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import heapq
+import itertools
+
+SOURCES = ('new', 'old', 'timeout')
+
+
+class Scheduler:
+    """ Job queue of the resolver.
+        One heap per source ordered by (runtime, attempts, -priority),
+        insertion order breaks ties. pop() interleaves sources by
+        weighted round robin, so new hashes, old hashes and timed out
+        jobs waiting for another try all keep moving.
+    """
+
+    def __init__(self, weights=None) -> None:
+        if weights is None:
+            weights = {'new': 1, 'old': 1, 'timeout': 1}
+        self.weights = weights
+        self.heaps = {}
+        for source in SOURCES:
+            self.heaps[source] = []
+        self.seq = itertools.count()
+        self.turns = self.make_turns()
+        self.turn = 0
+
+    def make_turns(self) -> list:
+        turns = []
+        for source in SOURCES:
+            turns.extend([source] * self.weights.get(source, 0))
+        assert turns, 'all scheduler weights are zero'
+        return turns
+
+    def push(self, source: str, item, runtime=0, attempts=0, priority=0):
+        heapq.heappush(self.heaps[source],
+                       (runtime, attempts, -priority, next(self.seq), item))
+
+    def pop(self) -> tuple:     # (source, item)
+        for _ in range(len(self.turns)):
+            source = self.turns[self.turn]
+            self.turn = (self.turn + 1) % len(self.turns)
+            if self.heaps[source]:
+                return source, heapq.heappop(self.heaps[source])[-1]
+
+        # sources with zero weight are only served when nothing else waits
+        for source in SOURCES:
+            if self.heaps[source]:
+                return source, heapq.heappop(self.heaps[source])[-1]
+        raise IndexError('pop from empty scheduler')
+
+    def count(self, source: str) -> int:
+        return len(self.heaps[source])
+
+    def waiting(self) -> int:   # hashes never spawned in this session
+        return len(self.heaps['new']) + len(self.heaps['old'])
+
+    def sleeping(self) -> int:
+        return len(self.heaps['timeout'])
+
+    def __len__(self) -> int:
+        return self.waiting() + self.sleeping()
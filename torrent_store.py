@@ -0,0 +1,246 @@
+#!/usr/bin/env python -u
+"""
+Content addressed store of .torrent files, keyed by infohash.
+
+    root/ab/cd/abcd....torrent      loose file, 2 level hex fan-out
+    root/packs/pack-00000.dat       small files appended back to back
+    root/packs/index                hexhash pack offset length, one per line
+
+Loose files are written to a temp file and renamed into place, a reader
+never sees half a file. Packed files are appended to the pack first and
+indexed after, an entry in the index always points at complete data.
+Only one process may write to a store.
+
+Run as a script to export torrents by name or to import a flat directory.
+"""
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import os
+import logging
+import tempfile
+import my_torrent_stuff
+
+logger = logging.getLogger(__name__)
+
+VERSION = "0.0.1"
+PACK_DIR = 'packs'
+PACK_SIZE = 1 << 30         # bytes per pack file before a new one is started
+PACK_THRESHOLD = 64 << 10   # files up to this size go to packs, if packing
+
+
+class TorrentStore:
+
+    def __init__(self, root: str, pack=False, pack_threshold=PACK_THRESHOLD,
+                 pack_size=PACK_SIZE, fsync=False) -> None:
+        self.root = root
+        self.pack = pack
+        self.pack_threshold = pack_threshold
+        self.pack_size = pack_size
+        self.fsync = fsync
+        self.index = {}         # hexhash -> (pack number, offset, length)
+        self.pack_no = 0
+        self.pack_h = None
+        self.index_h = None
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.load_index()
+
+    def path_of(self, hexhash: str) -> str:
+        hexhash = hexhash.lower()
+        return os.path.join(self.root, hexhash[:2], hexhash[2:4], hexhash + '.torrent')
+
+    def pack_path(self, pack_no: int) -> str:
+        return os.path.join(self.root, PACK_DIR, 'pack-{:05}.dat'.format(pack_no))
+
+    def load_index(self):
+        index_file = os.path.join(self.root, PACK_DIR, 'index')
+        if not os.path.exists(index_file):
+            return
+        pack_sizes = {}
+        with open(index_file, 'r', encoding='ascii') as f_h:
+            for line in f_h:
+                fields = line.split()
+                if len(fields) != 4 or not line.endswith('\n'):
+                    continue    # torn last line of a crashed run
+                hexhash = fields[0]
+                pack_no, offset, length = int(fields[1]), int(fields[2]), int(fields[3])
+                if pack_no not in pack_sizes:
+                    path = self.pack_path(pack_no)
+                    pack_sizes[pack_no] = os.path.getsize(path) if os.path.exists(path) else 0
+                if offset + length > pack_sizes[pack_no]:
+                    continue
+                self.index[hexhash] = (pack_no, offset, length)
+                self.pack_no = max(self.pack_no, pack_no)
+        logger.info('%s packed torrents in %s', len(self.index), self.root)
+
+    def __contains__(self, hexhash: str) -> bool:
+        hexhash = hexhash.lower()
+        return hexhash in self.index or os.path.exists(self.path_of(hexhash))
+
+    def put(self, hexhash: str, parts: list) -> bool:
+        """ Stores the .torrent made of parts (bytes-like),
+            False if the hash is stored already
+        """
+        hexhash = hexhash.lower()
+        if hexhash in self:
+            return False
+        length = sum(len(part) for part in parts)
+        if self.pack and length <= self.pack_threshold:
+            self.put_packed(hexhash, parts, length)
+        else:
+            self.put_loose(hexhash, parts)
+        return True
+
+    def put_loose(self, hexhash: str, parts: list):
+        path = self.path_of(hexhash)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f_h:
+                f_h.writelines(parts)
+                if self.fsync:
+                    f_h.flush()
+                    os.fsync(f_h.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def open_pack(self):
+        pack_dir = os.path.join(self.root, PACK_DIR)
+        if not os.path.exists(pack_dir):
+            os.makedirs(pack_dir)
+        if self.pack_h is not None:
+            self.pack_h.close()
+        self.pack_h = open(self.pack_path(self.pack_no), 'ab')
+        if self.index_h is None:
+            self.index_h = open(os.path.join(pack_dir, 'index'), 'a', encoding='ascii')
+
+    def put_packed(self, hexhash: str, parts: list, length: int):
+        if self.pack_h is None:
+            self.open_pack()
+        if self.pack_h.tell() and self.pack_h.tell() + length > self.pack_size:
+            self.pack_no += 1
+            self.open_pack()
+        offset = self.pack_h.tell()
+        self.pack_h.writelines(parts)
+        self.pack_h.flush()
+        if self.fsync:
+            os.fsync(self.pack_h.fileno())
+        # data first, the entry only once it is complete
+        self.index_h.write('{} {} {} {}\n'.format(hexhash, self.pack_no, offset, length))
+        self.index_h.flush()
+        self.index[hexhash] = (self.pack_no, offset, length)
+
+    def get(self, hexhash: str):
+        """ .torrent file contents, None if not stored """
+        hexhash = hexhash.lower()
+        entry = self.index.get(hexhash)
+        if entry is not None:
+            pack_no, offset, length = entry
+            with open(self.pack_path(pack_no), 'rb') as f_h:
+                f_h.seek(offset)
+                return f_h.read(length)
+        try:
+            with open(self.path_of(hexhash), 'rb') as f_h:
+                return f_h.read()
+        except FileNotFoundError:
+            return None
+
+    def export(self, hexhash: str, dest_dir: str, filename='') -> str:
+        """ Copies a stored torrent out as dest_dir/filename,
+            named after the torrent if no filename, returns the path
+        """
+        data = self.get(hexhash)
+        if data is None:
+            raise KeyError(hexhash)
+        if not filename:
+            record = my_torrent_stuff.TorrentRecord.from_torrent_file(data)
+            filename = record.name + '.torrent'
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        path = os.path.join(dest_dir, filename)
+        with open(path, 'wb') as f_h:
+            f_h.write(data)
+        return path
+
+    def hashes(self):
+        """ All stored hexhashes, packed first """
+        yield from self.index
+        for level1 in sorted(os.listdir(self.root)):
+            if len(level1) != 2 or not os.path.isdir(os.path.join(self.root, level1)):
+                continue
+            for level2 in sorted(os.listdir(os.path.join(self.root, level1))):
+                for name in sorted(os.listdir(os.path.join(self.root, level1, level2))):
+                    if name.endswith('.torrent'):
+                        yield name[:-len('.torrent')]
+
+    def close(self):
+        if self.pack_h is not None:
+            self.pack_h.close()
+            self.pack_h = None
+        if self.index_h is not None:
+            self.index_h.close()
+            self.index_h = None
+
+
+def import_dir(store: TorrentStore, directory: str):
+    added = 0
+    skipped = 0
+    for path, _, files in os.walk(directory):
+        for file in files:
+            if not file.endswith('.torrent'):
+                continue
+            with open(os.path.join(path, file), 'rb') as f_h:
+                data = f_h.read()
+            try:
+                record = my_torrent_stuff.TorrentRecord.from_torrent_file(data)
+            except (my_torrent_stuff.BencodeError, KeyError):
+                logger.warning('not a torrent %s', file)
+                skipped += 1
+                continue
+            if store.put(record.hexhash, [data]):
+                added += 1
+            else:
+                skipped += 1
+    print('imported {}, skipped {}'.format(added, skipped))
+
+
+def main():
+    store = TorrentStore(args.root, pack=args.pack)
+    try:
+        if args.import_dir:
+            import_dir(store, args.import_dir)
+        hexhashes = args.hashes
+        if args.all:
+            hexhashes = store.hashes()
+        for hexhash in hexhashes:
+            if args.output_dir:
+                print(store.export(hexhash, args.output_dir))
+            else:
+                print(hexhash, hexhash in store)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Look up, export or import .torrent files of a store')
+    parser.add_argument('root', help='store directory')
+    parser.add_argument('hashes', nargs='*', help='infohashes to look up or export')
+    parser.add_argument('-all', dest='all', default=False, action='store_true',
+                        help='every stored hash')
+    parser.add_argument('-o', dest='output_dir', default='', type=str,
+                        help='export to this directory, named after the torrents')
+    parser.add_argument('-import', dest='import_dir', default='', type=str,
+                        help='add .torrent files found in this directory')
+    parser.add_argument('-pack', dest='pack', default=False, action='store_true',
+                        help='imported small files go to pack files')
+    parser.add_argument('--version', action='version', version=VERSION)
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python -u
+"""
+Offline comparison of tracker selection strategies.
+
+Per tracker resolve probability is estimated from announce outcomes
+logged by resolver.py -trackerlog, then every strategy replays the same
+number of hashes starting from empty stats. A hash counts as resolved
+when any of its chosen trackers delivers.
+"""
+
+import array
+import json
+import random
+import tracker_selection
+
+VERSION = "0.0.1"
+
+
+def load_log(filename: str) -> dict:
+    estimates = {}
+    f_h = open(filename, "r", encoding='utf-8')
+    for line in f_h:
+        row = json.loads(line)
+        for url in row['trackers']:
+            if url not in estimates:
+                estimates[url] = {'uses': 0, 'resolves': 0}
+            estimates[url]['uses'] += 1
+            if row['resolved']:
+                estimates[url]['resolves'] += 1
+    f_h.close()
+
+    probabilities = {}
+    for url, stats in estimates.items():
+        # several trackers share the credit of one resolve
+        probabilities[url] = (stats['resolves'] / args.per_hash + 0.5) / (stats['uses'] + 1)
+    return probabilities
+
+
+def replay(strategy, probabilities: dict, hashes: int, seed: int) -> float:
+    rng = random.Random(seed)
+    urls = sorted(probabilities)
+    uses = array.array('q', bytes(8 * len(urls)))
+    resolves = array.array('q', bytes(8 * len(urls)))
+    total_uses = 0
+
+    resolved = 0
+    for _ in range(hashes):
+        chosen = strategy.select(uses, resolves, total_uses, args.per_hash)
+        success = False
+        for idx in chosen:
+            if rng.random() < probabilities[urls[idx]]:
+                success = True
+        for idx in chosen:
+            uses[idx] += 1
+            total_uses += 1
+            if success:
+                resolves[idx] += 1
+        if success:
+            resolved += 1
+    return resolved / hashes
+
+
+def main():
+    probabilities = load_log(args.log)
+    print('trackers in log', len(probabilities))
+    random.seed(args.seed)
+    for name in sorted(tracker_selection.STRATEGIES):
+        strategy = tracker_selection.make_strategy(name, args.explore)
+        rate = replay(strategy, probabilities, args.hashes, args.seed)
+        print('{:10} resolve rate {:.4f}'.format(name, rate))
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description='Replay logged announce outcomes against tracker selection strategies')
+
+    parser.add_argument('log', type=str,
+                        help='json lines file written by resolver.py -trackerlog')
+    parser.add_argument('-hashes', dest='hashes', default=100000, type=int,
+                        help='number of hashes to replay per strategy')
+    parser.add_argument('-pertorrent', dest='per_hash', default=3, type=int,
+                        help='trackers given to a single hash')
+    parser.add_argument('-explore', dest='explore', default=0.1, type=float,
+                        help='fraction of tracker slots always picked at random')
+    parser.add_argument('-seed', dest='seed', default=1, type=int,
+                        help='random seed, same for every strategy')
+
+    parser.add_argument('--version', action='version', version=VERSION)
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python -u
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+import functools
+import heapq
+import itertools
+import math
+import random
+
+
+class UniformSelection:
+    """ Every tracker equally likely, what get_random_url always did.
+        Strategies read the uses/resolves columns of the tracker registry
+        and return indexes of chosen trackers.
+    """
+
+    def __init__(self, explore=0.0) -> None:
+        # fraction of slots always filled uniformly at random
+        self.explore = explore
+
+    def select(self, uses, resolves, total_uses: int, amount: int) -> list:
+        if amount >= len(uses):
+            return list(range(len(uses)))
+        return random.sample(range(len(uses)), amount)
+
+
+def thompson_score(uses: int, resolves: int, total_uses: int) -> float:
+    """ Resolve probability sampled from the tracker's Beta posterior """
+    failures = max(uses - resolves, 0)
+    return random.betavariate(resolves + 1, failures + 1)
+
+
+def ucb_score(uses: int, resolves: int, total_uses: int, weight=1.0) -> float:
+    """ UCB1, resolve ratio plus confidence bonus shrinking with uses """
+    if uses == 0:
+        return math.inf
+    bonus = math.sqrt(2 * math.log(max(total_uses, 1)) / uses)
+    return resolves / uses + weight * bonus
+
+
+class ScoredSelection(UniformSelection):
+    """ Picks trackers with the highest score(uses, resolves, total_uses) """
+
+    def __init__(self, score, explore=0.0) -> None:
+        super().__init__(explore)
+        self.score = score
+
+    def select(self, uses, resolves, total_uses: int, amount: int) -> list:
+        if amount >= len(uses):
+            return list(range(len(uses)))
+
+        explore_slots = 0
+        for _ in range(amount):
+            if random.random() < self.explore:
+                explore_slots += 1
+
+        # only the best amount are kept, the registry is never sorted
+        scores = map(self.score, uses, resolves, itertools.repeat(total_uses))
+        chosen = []
+        for _, idx in heapq.nlargest(amount - explore_slots, zip(scores, range(len(uses)))):
+            chosen.append(idx)
+        taken = set(chosen)
+        while len(chosen) < amount:
+            idx = random.randrange(len(uses))
+            if idx not in taken:
+                taken.add(idx)
+                chosen.append(idx)
+        return chosen
+
+
+class ThompsonSelection(ScoredSelection):
+    """ Samples resolve probability of each tracker from Beta posterior """
+
+    def __init__(self, explore=0.0) -> None:
+        super().__init__(thompson_score, explore)
+
+
+class UcbSelection(ScoredSelection):
+    """ UCB1, resolve ratio plus confidence bonus shrinking with uses """
+
+    def __init__(self, explore=0.0, weight=1.0) -> None:
+        super().__init__(functools.partial(ucb_score, weight=weight), explore)
+        self.weight = weight
+
+
+STRATEGIES = {
+    'uniform': UniformSelection,
+    'thompson': ThompsonSelection,
+    'ucb': UcbSelection,
+}
+
+
+def make_strategy(name: str, explore=0.0) -> UniformSelection:
+    return STRATEGIES[name](explore=explore)